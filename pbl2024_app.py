@@ -2,54 +2,71 @@
 
 # IMPORT LIBRARIES
 import csv
-from scholarly import scholarly
-import feedparser
 import urllib.parse
-from openai import OpenAI
 import requests
+import urllib3
 import time
 import os
 import re
 import random
-from lumaai import LumaAI
-from moviepy.editor import VideoFileClip, AudioFileClip, concatenate_videoclips, TextClip, CompositeVideoClip, CompositeAudioClip
-from resemble import Resemble
-from pydub import AudioSegment
-from moviepy import editor
+import math
+import fractions
+import uuid
+import secrets
+import html
+import queue
+import contextlib
+import collections
+import contextvars
+import functools
+import json
+import hashlib
+import email.utils
+import shutil
+import tempfile
+import asyncio
+import threading
+try:
+    import fcntl # Locks the run being worked on
+except ImportError: # Windows
+    fcntl = None
+    import msvcrt
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
 import textwrap
 import streamlit as st
-from moviepy.config import change_settings
+from streamlit import runtime
+import sys
+import argparse
 
-# INITIALIZE API KEYS
+# scholarly, feedparser, openai, lumaai and resemble are imported by the stage that uses them, so the app starts and reruns faster
 
-# API Keys Setup
-st.sidebar.header("API Keys")
-openai_key = st.sidebar.text_input("OpenAI API Key", type="password")
-resemble_key = st.sidebar.text_input("Resemble API Key", type="password")
-lumaai_key = st.sidebar.text_input("LumaAI API Key", type="password")
-google_api_key = st.sidebar.text_input("Google API Key", type="password")
-google_cse_id = st.sidebar.text_input("Google Custom Search Engine ID")
+# INITIALIZE API KEYS
 
-# Initialize APIs if keys are provided
-if openai_key:
-    from openai import OpenAI
-    client = OpenAI(api_key=openai_key)
+# API Keys Setup, from the sidebar in the app and from environment variables when rendering in batch
+if runtime.exists():
+    st.sidebar.header("API Keys")
+    openai_key = st.sidebar.text_input("OpenAI API Key", type="password")
+    resemble_key = st.sidebar.text_input("Resemble API Key", type="password")
+    lumaai_key = st.sidebar.text_input("LumaAI API Key", type="password")
+    google_api_key = st.sidebar.text_input("Google API Key", type="password")
+    google_cse_id = st.sidebar.text_input("Google Custom Search Engine ID")
 else:
+    openai_key = os.environ.get("OPENAI_API_KEY", "")
+    resemble_key = os.environ.get("RESEMBLE_API_KEY", "")
+    lumaai_key = os.environ.get("LUMAAI_API_KEY", "")
+    google_api_key = os.environ.get("GOOGLE_API_KEY", "")
+    google_cse_id = os.environ.get("GOOGLE_CSE_ID", "")
+
+# Check the keys, the API clients are created once per key the first time a stage needs them (see get_openai_client, get_luma_client and get_resemble_project)
+if not openai_key:
     st.error("Please provide your OpenAI API key.")
 
-if resemble_key:
-    from resemble import Resemble
-    Resemble.api_key(resemble_key)
-    project_uuid = Resemble.v2.projects.all(1, 10)['items'][0]['uuid']
-    voice_uuid = '0842fdf9'
-else:
+voice_uuid = '0842fdf9'
+if not resemble_key:
     st.error("Please provide your Resemble API key.")
 
-if lumaai_key:
-    from lumaai import LumaAI
-    client_luma = LumaAI(auth_token=lumaai_key)
-else:
+if not lumaai_key:
     st.error("Please provide your LumaAI API key.")
 
 if google_api_key and google_cse_id:
@@ -60,11 +77,700 @@ else:
 
 # DEFINE FUNCTIONS TO USE
 
-# Function to fetch news articles
+# Generation settings, they are part of the cache key of everything generated with them
+SCRIPT_MODEL = "gpt-4"
+VIDEO_ASPECT_RATIO = "16:9"
+CAMERA_INSTRUCTIONS = "camera fixes, no camera movement"
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+FFPROBE_BINARY = os.environ.get("FFPROBE_BINARY", "ffprobe")
+MEDIA_CACHE_DIR = os.environ.get("PBL_CACHE_DIR", ".media_cache")
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get("PBL_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+CONTEXT_CACHE_TTL = 6 * 60 * 60 # Seconds before fetching the news and papers of the same query again
+PAPERS_TIME_BUDGET = 60 # Seconds searching papers before going on with what was found
+PAPERS_MAX_CHECKED = 200 # Papers checked before going on with what was found
+RUNS_DIR = os.environ.get("PBL_RUNS_DIR", "runs")
+RUNS_MAX_BYTES = int(os.environ.get("PBL_RUNS_MAX_BYTES", 5 * 1024 ** 3)) # Size of the runs before the intermediate files of the oldest ones are deleted
+RUNS_MAX_AGE = float(os.environ.get("PBL_RUNS_MAX_AGE", 7 * 24 * 60 * 60)) # Seconds before the intermediate files of a run are deleted
+RUNS_ACTIVE_SECONDS = 60 * 60 # Runs updated more recently may still be running, they are never collected
+RUN_WAIT_SECONDS = 2 # How often a session waiting for a run checks if it has been let go
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static") # Served from disk by Streamlit at app/static, see .streamlit/config.toml
+SCRATCH_DIR = os.environ.get("PBL_SCRATCH_DIR", "") # Folder for the files being downloaded or encoded, a tmpfs like /dev/shm keeps them off the disk, inside every run folder if empty
+NEWS_RSS_URL = os.environ.get("PBL_NEWS_RSS_URL", "https://news.google.com/rss/search?q=")
+LUMA_CLIP_SECONDS = 5.0 # Length of the clips generated by LumaAI
+FIT_METHOD = os.environ.get("PBL_FIT_METHOD", "loop") # How a scene video is stretched to its narration: loop (the clips are generated as seamless loops), pingpong or retime
+FIT_MAX_LOOPS = int(os.environ.get("PBL_FIT_MAX_LOOPS", 2)) # Times a scene video can be played before asking LumaAI for another clip
+FIT_MAX_SLOWDOWN = float(os.environ.get("PBL_FIT_MAX_SLOWDOWN", 1.25)) # Largest slow down of a scene video before the motion stops looking natural
+SUBTITLE_LINE_WIDTH = 42 # Characters per subtitle line, two lines per cue
+RATE_LIMITS = { # Requests per minute and calls at the same time allowed for every provider, shared by all the sessions of the process
+    provider: (int(os.environ.get(f"PBL_{provider.upper()}_RPM", rpm)), int(os.environ.get(f"PBL_{provider.upper()}_CONCURRENCY", concurrency)))
+    for provider, rpm, concurrency in [("openai", 500, 8), ("resemble", 60, 4), ("luma", 120, 10), ("google", 100, 4)]
+}
+RATE_LIMIT_RETRIES = 5 # Retries of a throttled or failed call before giving up
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+PREVIEW_HEIGHT = 360 # Height of the preview shown before the full-quality render
+PREVIEW_FRAME_RATE = 12
+VIDEO_ENCODE = ["-c:v", "libx264", "-preset", "medium", "-crf", "20", "-pix_fmt", "yuv420p"]
+PREVIEW_VIDEO_ENCODE = ["-c:v", "libx264", "-preset", "ultrafast", "-crf", "30", "-pix_fmt", "yuv420p"]
+SEGMENT_WORKERS = 2 # Scenes encoded at the same time, ffmpeg already uses several cores for each
+BACKGROUND_MUSIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bollywoodkollywood-sad-love-bgm-13349.mp3")
+
+# The tracer of the run, the stage and the scene being measured in the current thread
+current_tracer = contextvars.ContextVar("current_tracer", default=None)
+current_span = contextvars.ContextVar("current_span", default=None)
+current_scene = contextvars.ContextVar("current_scene", default=None)
+current_scratch_dir = contextvars.ContextVar("current_scratch_dir", default=None) # Scratch folder of the attempt of the run being generated
+
+# Class to hold the measures of one call to a stage: wall time, time waiting for other services, encode time, bytes downloaded and API calls
+class Span:
+    def __init__(self, tracer, stage, scene):
+        self.tracer = tracer
+        self.stage = stage
+        self.scene = scene
+        self.start = time.time()
+        self.wall = 0.0
+        self.wait = 0.0
+        self.encode = 0.0
+        self.bytes = 0
+        self.api_calls = 0
+
+    def to_dict(self):
+        return {
+            "stage": self.stage,
+            "scene": self.scene,
+            "start": round(self.start - self.tracer.started, 3),
+            "wall": round(self.wall, 3),
+            "wait": round(self.wait, 3),
+            "work": round(max(0.0, self.wall - self.wait), 3), # Time spent in this process rather than waiting for the network or an API
+            "encode": round(self.encode, 3),
+            "bytes": self.bytes,
+            "api_calls": self.api_calls,
+        }
+
+# Class to collect the spans of a run and summarize them per stage and per scene
+class Tracer:
+    def __init__(self):
+        self.started = time.time()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span, measure, amount):
+        with self.lock:
+            setattr(span, measure, getattr(span, measure) + amount)
+
+    def summary(self):
+        with self.lock:
+            spans = [span.to_dict() for span in self.spans]
+        measures = ["wall", "wait", "work", "encode", "bytes", "api_calls"]
+        stages = {}
+        scenes = {}
+        for span in spans:
+            stage = stages.setdefault(span["stage"], dict({"calls": 0}, **{measure: 0 for measure in measures}))
+            stage["calls"] += 1
+            for measure in measures:
+                stage[measure] += span[measure]
+            if span["scene"] is not None:
+                scene = scenes.setdefault(str(span["scene"]), {"first_start": span["start"], "last_end": 0, "bytes": 0, "api_calls": 0, "encode": 0})
+                scene["first_start"] = min(scene["first_start"], span["start"])
+                scene["last_end"] = max(scene["last_end"], span["start"] + span["wall"])
+                for measure in ("bytes", "api_calls", "encode"):
+                    scene[measure] += span[measure]
+        for stage in stages.values():
+            for measure in ("wall", "wait", "work", "encode"):
+                stage[measure] = round(stage[measure], 3)
+        for scene in scenes.values():
+            scene["wall"] = round(scene.pop("last_end") - scene["first_start"], 3) # From the first stage of the scene to the end of its last one
+            scene["encode"] = round(scene["encode"], 3)
+        return {"total_wall": round(time.time() - self.started, 3), "stages": stages, "scenes": scenes}
+
+    # Write every span and the summary as JSON
+    def write(self, file_name):
+        summary = self.summary()
+        with self.lock:
+            spans = [span.to_dict() for span in self.spans]
+        with open(file_name, "w", encoding="utf-8") as file:
+            json.dump({"summary": summary, "spans": spans}, file, indent=2)
+        return summary
+
+# Function to measure a stage, it does nothing when no run is being traced
+@contextlib.contextmanager
+def trace_stage(stage):
+    tracer = current_tracer.get()
+    if tracer is None:
+        yield None
+        return
+    span = Span(tracer, stage, current_scene.get())
+    token = current_span.set(span)
+    try:
+        yield span
+    finally:
+        span.wall = time.time() - span.start
+        current_span.reset(token)
+        with tracer.lock:
+            tracer.spans.append(span)
+
+# Function to add to a measure of the stage running in this thread (or of the given span)
+def trace_add(measure, amount=1, span=None):
+    span = span or current_span.get()
+    if span is not None:
+        span.tracer.add(span, measure, amount)
+
+# Function to count the time inside it as waiting for another service
+@contextlib.contextmanager
+def trace_wait(api_call=False):
+    start = time.time()
+    try:
+        yield
+    finally:
+        trace_add("wait", time.time() - start)
+        if api_call:
+            trace_add("api_calls")
+
+# Decorator to trace every call to a stage of the pipeline
+def traced(stage):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with trace_stage(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Class to reuse scripts, narrations and videos already generated for the same prompt and parameters
+class MediaCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    # Key of a generation, a hash of what it is, its prompt and every parameter that changes the result
+    def key(self, kind, prompt, **params):
+        payload = json.dumps({"kind": kind, "prompt": prompt, "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    # Return the cached file of a key, or None if it was never generated or has been evicted
+    def get(self, key, extension):
+        path = self.path(key, extension)
+        with self.lock:
+            if os.path.exists(path):
+                os.utime(path) # Mark it as recently used for the LRU eviction
+                self.hits += 1
+                return path
+            self.misses += 1
+            return None
+
+    # Move a generated file into the cache and return its cached path
+    def put(self, key, extension, file_name):
+        path = self.path(key, extension)
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        shutil.move(file_name, temporary) # A rename when both are in the same disk, the file is not copied
+        os.replace(temporary, path) # Atomic, a concurrent reader never sees a half written file
+        os.utime(path) # Moving keeps the time of the original file, the new entry must not look old to the eviction
+        self.evict()
+        return path
+
+    def get_text(self, key):
+        path = self.get(key, ".txt")
+        if path is None:
+            return None
+        with open(path, encoding="utf-8") as file:
+            return file.read()
+
+    def put_text(self, key, text):
+        temporary = self.path(key, f".{uuid.uuid4().hex}.tmp")
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.write(text)
+        os.replace(temporary, self.path(key, ".txt"))
+        self.evict()
+
+    # Remove the least recently used files until the cache fits in its size budget
+    def evict(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(self.directory, name)
+                with contextlib.suppress(FileNotFoundError): # Evicted by another process sharing the cache
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            now = time.time()
+            for modified, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if now - modified < RUNS_ACTIVE_SECONDS: # Returned or stored recently, a run may still be using it
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                total -= size
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+# Function to get the cache shared by every session
+@st.cache_resource
+def get_media_cache():
+    return MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES)
+
+# Function to get the HTTP session shared by every download, it keeps the connections open between downloads
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Function to stream a file to disk by chunks, if the connection breaks it continues from the last byte received
+def download_file(url, file_name, retries=3):
+    session = get_http_session()
+    partial_file = file_name + ".part"
+    for attempt in range(retries + 1):
+        downloaded = os.path.getsize(partial_file) if os.path.exists(partial_file) else 0
+        headers = {"Range": f"bytes={downloaded}-"} if downloaded else {}
+        try:
+            with session.get(url, stream=True, headers=headers, timeout=(10, 60)) as response:
+                if downloaded and response.status_code == 416: # Nothing left to download
+                    break
+                response.raise_for_status()
+                mode = "ab" if response.status_code == 206 else "wb" # The server may ignore the range and send the whole file again
+                with open(partial_file, mode) as file:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        file.write(chunk)
+                        trace_add("bytes", len(chunk))
+            break
+        except requests.RequestException as e:
+            status = getattr(e.response, "status_code", None) # None when the connection broke or timed out
+            if attempt == retries or (status is not None and status not in RETRY_STATUSES): # An expired or missing file is not there on the next attempt either
+                raise
+            time.sleep(2 ** attempt + random.random())
+    os.replace(partial_file, file_name)
+    return file_name
+
+# Class to persist what every stage of a run produced, so a failed run continues where it stopped instead of paying every generation again
+class RunState:
+    def __init__(self, run_dir, params, fresh=False):
+        self.run_dir = run_dir
+        self.manifest_file = os.path.join(run_dir, "manifest.json")
+        self.owner_file = os.path.join(run_dir, "owner.lock") # Locked while a session works on the run
+        self.owner = None # Descriptor holding the lock
+        self.params = params
+        self.fresh = fresh
+        if SCRATCH_DIR: # One folder per run, named after its full path so runs of different folders never share it
+            self.scratch_dir = os.path.join(SCRATCH_DIR, "pbl2024_" + hashlib.sha256(os.path.abspath(run_dir).encode("utf-8")).hexdigest()[:16])
+        else:
+            self.scratch_dir = os.path.join(run_dir, "scratch")
+        self.lock = threading.Lock()
+        os.makedirs(run_dir, exist_ok=True)
+        self.load()
+
+    # Read the manifest of the run, a new run is started when there is none or a fresh one was requested,
+    # it is written once the run is claimed since another session may still be working on the old one
+    def load(self):
+        self.data = None
+        if os.path.exists(self.manifest_file) and not self.fresh:
+            with open(self.manifest_file, encoding="utf-8") as file:
+                self.data = json.load(file)
+            # A folder used before for other settings, like a batch job whose line was edited, starts again, None reads any run
+            if self.params is not None and json.dumps(self.data["params"], sort_keys=True) != json.dumps(self.params, sort_keys=True):
+                self.data = None
+        if self.data is None:
+            self.data = {
+                "params": self.params,
+                "status": "created",
+                "context": None,
+                "context_file": None,
+                "script": None,
+                "scenes": [], # One entry per scene: its text, narration, voice file, LumaAI ids and downloaded parts
+                "final_video": None,
+                "error": None,
+            }
+
+    # Take the run for this session and read what the previous one left, False while another session works on it:
+    # two sessions on the same run overwrite each other's manifest and pay the same generations twice.
+    # The lock is taken by the system in a single step and let go when its process ends, even if it crashed
+    def claim(self, load=True):
+        descriptor = os.open(self.owner_file, os.O_CREAT | os.O_RDWR)
+        try:
+            if fcntl:
+                fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB) # Also between the sessions of the same process
+            else:
+                msvcrt.locking(descriptor, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(descriptor)
+            return False
+        self.owner = descriptor
+        if load:
+            self.load()
+            self.fresh = False # The next attempts of this session continue the run
+            self.save()
+        return True
+
+    # Let the run go so another session can work on it, the file stays: removing it would let two sessions lock different files
+    def release(self):
+        if self.owner is None:
+            return
+        if fcntl:
+            fcntl.flock(self.owner, fcntl.LOCK_UN)
+        else:
+            with contextlib.suppress(OSError):
+                os.lseek(self.owner, 0, os.SEEK_SET)
+                msvcrt.locking(self.owner, msvcrt.LK_UNLCK, 1)
+        os.close(self.owner)
+        self.owner = None
+
+    # Write the manifest atomically, a crash in the middle never leaves it half written
+    def save(self):
+        with self.lock:
+            self.data["updated"] = time.time()
+            temporary = f"{self.manifest_file}.{uuid.uuid4().hex}.tmp"
+            with open(temporary, "w", encoding="utf-8") as file:
+                json.dump(self.data, file, indent=2)
+            os.replace(temporary, self.manifest_file)
+
+    def update(self, **values):
+        with self.lock:
+            self.data.update(values)
+        self.save()
+
+    def add_scene(self, scene, narrator):
+        with self.lock:
+            self.data["scenes"].append({"scene": scene, "narrator": narrator})
+        self.save()
+
+    def update_scene(self, index, **values):
+        with self.lock:
+            self.data["scenes"][index].update(values)
+        self.save()
+
+    # Remember the LumaAI generation of a part of a scene, None forgets it so the next attempt creates a new one
+    def update_generation(self, index, part, generation_id):
+        with self.lock:
+            luma_ids = self.data["scenes"][index].setdefault("luma_ids", [])
+            luma_ids.extend([None] * (part + 1 - len(luma_ids)))
+            luma_ids[part] = generation_id
+        self.save()
+
+    # Keep a file in the run directory, a hard link when possible so nothing is copied
+    def keep(self, file_name, name):
+        path = os.path.join(self.run_dir, name)
+        if os.path.abspath(file_name) == os.path.abspath(path):
+            return path
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            os.link(file_name, path)
+        except OSError:
+            shutil.copyfile(file_name, path)
+        return path
+
+    # Files of the run that are kept when its intermediate files are collected
+    def deliverables(self):
+        files = [self.manifest_file, self.owner_file, os.path.join(self.run_dir, "trace.json"), os.path.join(self.run_dir, "published.json"), self.data.get("final_video"), self.data.get("context_file")] + (self.data.get("subtitle_files") or [])
+        return {os.path.abspath(file_name) for file_name in files if file_name}
+
+    # Delete the files being downloaded or encoded by every attempt, only for runs no session works on
+    def clean_scratch(self):
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+# Function to get a collision-free name for an intermediate file in the scratch folder of the current run
+def scratch_file(prefix, extension):
+    directory = current_scratch_dir.get() or SCRATCH_DIR or tempfile.gettempdir()
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{prefix}_{uuid.uuid4().hex}{extension}")
+
+# Function to delete the intermediate files of old runs, keeping their final video, until the runs fit in their age and size budget
+def collect_runs(runs_dir=RUNS_DIR, max_bytes=RUNS_MAX_BYTES, max_age=RUNS_MAX_AGE, skip=None):
+    if not os.path.isdir(runs_dir):
+        return 0
+    runs = []
+    for name in os.listdir(runs_dir):
+        run_dir = os.path.join(runs_dir, name)
+        if os.path.exists(os.path.join(run_dir, "manifest.json")) and os.path.abspath(run_dir) != os.path.abspath(skip or ""):
+            try:
+                run_state = RunState(run_dir, None)
+            except (OSError, ValueError): # A manifest being written by another process, it is not old
+                continue
+            files = [os.path.join(folder, file_name) for folder, _, file_names in os.walk(run_dir) for file_name in file_names]
+            runs.append((run_state.data.get("updated", 0), run_state, {file_name: os.path.getsize(file_name) for file_name in files}))
+    total = sum(sum(sizes.values()) for _, _, sizes in runs)
+
+    freed = 0
+    now = time.time()
+    for updated, run_state, sizes in sorted(runs, key=lambda run: run[0]): # Oldest first
+        if now - updated < RUNS_ACTIVE_SECONDS:
+            continue
+        if now - updated < max_age and total <= max_bytes:
+            break
+        if not run_state.claim(load=False): # A session is working on it, it cannot start while its files are deleted
+            continue
+        try:
+            final_video = run_state.data.get("final_video")
+            if run_state.data.get("status") == "completed" and final_video and os.path.exists(final_video):
+                deliverables = run_state.deliverables()
+                removed = [file_name for file_name in sizes if os.path.abspath(file_name) not in deliverables]
+            else:
+                removed = list(sizes) # Nothing worth keeping in a run that never finished
+            published = read_published(run_state.run_dir)
+            for file_name in removed:
+                with contextlib.suppress(OSError, TypeError):
+                    os.remove(published.get(os.path.basename(file_name))) # The copy served to the browser keeps the file on disk otherwise
+                with contextlib.suppress(OSError):
+                    os.remove(file_name)
+                    total -= sizes[file_name]
+                    freed += sizes[file_name]
+            run_state.clean_scratch()
+        finally:
+            run_state.release()
+        if len(removed) == len(sizes):
+            shutil.rmtree(run_state.run_dir, ignore_errors=True)
+    return freed
+
+# Function to read the copies of the files of a run served to the browser, by file name
+def read_published(run_dir):
+    try:
+        with open(os.path.join(run_dir, "published.json"), encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+# Function to serve a file of a run from disk through the static folder of Streamlit, it returns None if Streamlit cannot serve it that way.
+# Anyone who knows the URL can download the file without a session, so it is published under a random name that cannot be
+# guessed from the settings of the run, kept while the file does not change so the browser does not load it again on every rerun
+def publish_file(file_name):
+    from streamlit.web.server import app_static_file_handler
+    max_size = getattr(app_static_file_handler, "MAX_APP_STATIC_FILE_SIZE", None) # Larger files are not served, another Streamlit version may not have it
+    if not st.get_option("server.enableStaticServing") or max_size is None or os.path.getsize(file_name) > max_size:
+        return None
+
+    run_dir = os.path.dirname(os.path.abspath(file_name))
+    published = read_published(run_dir)
+    path = published.get(os.path.basename(file_name))
+    if not (path and os.path.exists(path) and (os.path.samefile(path, file_name) or os.path.getmtime(path) == os.path.getmtime(file_name))):
+        if path: # A new attempt of the run replaced the file
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        os.makedirs(STATIC_DIR, exist_ok=True)
+        path = os.path.join(STATIC_DIR, f"{secrets.token_urlsafe(16)}_{os.path.basename(file_name)}")
+        try:
+            os.link(file_name, path) # Same file on disk, nothing is copied
+        except OSError:
+            shutil.copy2(file_name, path)
+        published[os.path.basename(file_name)] = path
+        temporary = os.path.join(run_dir, f"published.json.{uuid.uuid4().hex}.tmp")
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(published, file, indent=2)
+        os.replace(temporary, os.path.join(run_dir, "published.json"))
+
+    # st.video only leaves absolute URLs to the browser, relative paths are read into memory
+    origin = st.context.headers.get("Origin") or f"http://{st.context.headers.get('Host', 'localhost:8501')}"
+    base_path = st.get_option("server.baseUrlPath").strip("/")
+    return f"{origin}/{base_path + '/' if base_path else ''}app/static/{urllib.parse.quote(os.path.basename(path))}"
+
+# Function to get what st.video plays, the copy served from disk when Streamlit sends mp4 files as videos, otherwise the file itself,
+# which Streamlit keeps in memory: every other file is sent as text/plain with nosniff and some browsers refuse to play it
+def video_source(file_name):
+    from streamlit.web.server import app_static_file_handler
+    if ".mp4" in getattr(app_static_file_handler, "SAFE_APP_STATIC_FILE_EXTENSIONS", ()):
+        return publish_file(file_name) or file_name
+    return file_name
+
+# Function to open the run of a set of parameters, the same settings continue the same run unless a fresh one is requested
+def get_run_state(params, fresh=False):
+    run_id = hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return RunState(os.path.join(RUNS_DIR, run_id), params, fresh=fresh)
+
+# Function to tell if a failed call never reached the provider, the connection could not be opened
+def request_never_sent(error):
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError):
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+    # The OpenAI and LumaAI clients raise from the httpx error, httpx is not imported for this
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError") and type(error.__cause__).__name__ in ("ConnectError", "ConnectTimeout")
+
+# Class to keep the calls to a provider under its quota: a token bucket for the requests per minute, a limit of calls at the same time,
+# and retries with jitter that wait what the provider asks for in Retry-After, so a 429 slows every session down instead of failing a scene
+class RateLimiter:
+    def __init__(self, provider, requests_per_minute, max_concurrent, max_retries=RATE_LIMIT_RETRIES):
+        self.provider = provider
+        self.rate = requests_per_minute / 60
+        self.capacity = max_concurrent # Largest burst of calls
+        self.tokens = self.capacity
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.refilled = time.monotonic()
+        self.paused_until = 0.0 # After a 429 no call is made until the provider said it is fine again
+        self.active = 0
+        self.waiting = 0
+        self.metrics = {"calls": 0, "throttled": 0, "retries": 0, "max_waiting": 0, "wait_seconds": 0.0}
+        self.condition = threading.Condition()
+
+    # Block until a call can be made
+    def acquire(self):
+        start = time.monotonic()
+        with self.condition:
+            self.waiting += 1
+            self.metrics["max_waiting"] = max(self.metrics["max_waiting"], self.waiting)
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+                if now < self.paused_until:
+                    self.condition.wait(self.paused_until - now)
+                elif self.active >= self.max_concurrent:
+                    self.condition.wait() # Woken up when a call ends
+                elif self.tokens < 1:
+                    self.condition.wait((1 - self.tokens) / self.rate)
+                else:
+                    break
+            self.tokens -= 1
+            self.active += 1
+            self.waiting -= 1
+            self.metrics["calls"] += 1
+            self.metrics["wait_seconds"] += time.monotonic() - start
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    # Seconds to wait before retrying a failed call, None if it must not be retried
+    def retry_delay(self, error, attempt, idempotent=True):
+        response = getattr(error, "response", None)
+        status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+        if status is not None:
+            retryable = status in RETRY_STATUSES if idempotent else status in (429, 503) # A call that creates a paid generation is only retried when it was rejected
+        elif idempotent:
+            retryable = isinstance(error, (requests.ConnectionError, requests.Timeout)) or type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+        else:
+            retryable = request_never_sent(error) # A read timeout or a dropped connection may have created the generation, the run resumes the scene instead
+        if not retryable or attempt >= self.max_retries:
+            return None
+
+        delay = min(60, 2 ** attempt) * random.uniform(0.5, 1.5) # Jittered so the sessions throttled together do not retry together
+        headers = getattr(response, "headers", None) or {}
+        try:
+            if headers.get("retry-after-ms"):
+                delay = float(headers["retry-after-ms"]) / 1000
+            elif headers.get("retry-after"):
+                retry_after = headers["retry-after"]
+                delay = float(retry_after) if retry_after.replace(".", "", 1).isdigit() else email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+            delay = max(0.0, delay) + random.uniform(0, 0.5)
+        except (TypeError, ValueError):
+            pass
+        with self.condition:
+            self.metrics["retries"] += 1
+            if status == 429: # The quota is shared, every caller waits
+                self.metrics["throttled"] += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        return delay
+
+    # Make a call within the limits, retrying it while the provider is throttling or failing
+    def call(self, function, *args, idempotent=True, **kwargs):
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(e, attempt, idempotent)
+                if delay is None:
+                    raise
+            finally:
+                self.release()
+            time.sleep(delay)
+            attempt += 1
+
+    # Same as call for the coroutines of the LumaAI poller, the wait for a slot does not block its event loop
+    async def call_async(self, function, *args, idempotent=True, **kwargs):
+        attempt = 0
+        while True:
+            await asyncio.get_running_loop().run_in_executor(None, self.acquire)
+            try:
+                return await function(*args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(e, attempt, idempotent)
+                if delay is None:
+                    raise
+            finally:
+                self.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        with self.condition:
+            return dict(self.metrics, waiting=self.waiting, active=self.active, wait_seconds=round(self.metrics["wait_seconds"], 3))
+
+# Function to get the limiter of a provider, a single one per process so every session shares the quota
+@st.cache_resource
+def get_rate_limiter(provider):
+    return RateLimiter(provider, *RATE_LIMITS[provider])
+
+# Function to get the calls, throttling and queue of every provider since the app started
+def rate_limit_stats():
+    return {provider: get_rate_limiter(provider).stats() for provider in RATE_LIMITS}
+
+# Function to create a single OpenAI client per key, shared by every rerun and every session
+@st.cache_resource
+def get_openai_client(key):
+    from openai import OpenAI
+    return OpenAI(api_key=key, max_retries=0) # Retries are left to the rate limiter, it knows about the other sessions
+
+# Function to create a single LumaAI client per key, shared by every rerun and every session
+@st.cache_resource
+def get_luma_client(key):
+    from lumaai import LumaAI
+    return LumaAI(auth_token=key, max_retries=0)
+
+# Function to look up the Resemble project once per key instead of on every rerun
+@st.cache_resource
+def get_resemble_project(key):
+    from resemble import Resemble
+    if os.environ.get("RESEMBLE_BASE_URL"): # OpenAI and LumaAI read their own OPENAI_BASE_URL and LUMAAI_BASE_URL
+        Resemble.base_url(os.environ["RESEMBLE_BASE_URL"])
+    Resemble.api_key(key)
+
+    # Same request as Resemble.v2.projects.all, which returns the body of a throttled call as if it had succeeded
+    def list_projects():
+        response = get_http_session().get(
+            Resemble.endpoint("v2", "projects"),
+            headers={"Content-Type": "application/json", "Authorization": f"Token token={key}"},
+            params={"page": 1, "page_size": 10},
+            timeout=(10, 60),
+        )
+        response.raise_for_status()
+        return response.json()
+
+    return get_rate_limiter("resemble").call(list_projects)['items'][0]['uuid']
+
+# Class to tell that a source failed instead of having nothing about the query, with what it found before failing,
+# raised from the cached fetches so a failure is never kept as an empty context and the next run tries again
+class FetchError(RuntimeError):
+    def __init__(self, message, results):
+        super().__init__(message)
+        self.results = results
+
+# Function to fetch news articles, the same query is not fetched again until its results expire
+@traced("fetch_news")
+@st.cache_data(ttl=CONTEXT_CACHE_TTL, show_spinner=False)
 def fetch_news(query, num_needed=10):
-    base_url = "https://news.google.com/rss/search?q=" # We check in google news topics related to the user's input to assure the summary has updated information
+    import feedparser
+    base_url = NEWS_RSS_URL # We check in google news topics related to the user's input to assure the summary has updated information
     encoded_query = urllib.parse.quote(query)
-    feed = feedparser.parse(base_url + encoded_query)
+    with trace_wait(api_call=True):
+        feed = feedparser.parse(base_url + encoded_query)
+    if not feed.entries and (feed.get("bozo") or feed.get("status", 200) >= 400): # feedparser does not raise, a failed download is an empty feed
+        raise FetchError(f"Could not fetch the news (status {feed.get('status', 'unknown')}): {feed.get('bozo_exception', '')}", [])
     entries = feed.entries[:num_needed]
 
     results = []
@@ -78,15 +784,65 @@ def fetch_news(query, num_needed=10):
         })
     return results
 
-# Function to fetch academic papers
-def fetch_papers(query, num_needed):
-    search_query = scholarly.search_pubs(query) # We check in google scholar topics related to the user's input to assure the summary has updated information
+# Function to read the publications of a search in a background thread, so the next page is downloaded while the current one is checked
+# The last item is None when the search ended, or the error that stopped it
+def prefetch_publications(query, publications, stop, max_errors=5):
+    from scholarly import scholarly # The slowest import of the app, only needed when searching papers
+    reason = None
+    try:
+        search_query = scholarly.search_pubs(query) # We check in google scholar topics related to the user's input to assure the summary has updated information
+        errors = 0
+        while not stop.is_set():
+            try:
+                publication = next(search_query)
+                errors = 0
+            except StopIteration:
+                break
+            except Exception as e:
+                errors += 1
+                if errors >= max_errors: # Google scholar keeps failing (usually blocking us), stop instead of retrying forever
+                    reason = e
+                    break
+                continue
+            while not stop.is_set():
+                try:
+                    publications.put(publication, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+    except Exception as e:
+        reason = e
+    finally:
+        # Tell the reader that there are no more publications and why
+        while not stop.is_set():
+            try:
+                publications.put(reason, timeout=1)
+                break
+            except queue.Full:
+                continue
+
+# Function to fetch academic papers, within a time and item budget so rare topics do not search for minutes
+@traced("fetch_papers")
+@st.cache_data(ttl=CONTEXT_CACHE_TTL, show_spinner=False)
+def fetch_papers(query, num_needed, time_budget=PAPERS_TIME_BUDGET, max_checked=PAPERS_MAX_CHECKED):
+    publications = queue.Queue(maxsize=20)
+    stop = threading.Event()
+    threading.Thread(target=prefetch_publications, args=(query, publications, stop), daemon=True).start()
     results = []
     num_checked = 0
+    deadline = time.time() + time_budget
 
-    while len(results) < num_needed: # We create a loop to fetch as many entries as the user decide to give a context as broad as the user wants to GPT of what the academic community think about the given topic
-        try:
-            publication = next(search_query)
+    try:
+        while len(results) < num_needed and num_checked < max_checked: # We create a loop to fetch as many entries as the user decide to give a context as broad as the user wants to GPT of what the academic community think about the given topic
+            try:
+                with trace_wait():
+                    publication = publications.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if publication is None:
+                break
+            if isinstance(publication, Exception):
+                raise FetchError(f"Google Scholar stopped answering after {num_checked} papers: {publication}", results) from publication
             num_checked += 1
             num_citations = publication.get("num_citations", 0)
 
@@ -101,38 +857,53 @@ def fetch_papers(query, num_needed):
                     "PDF Link": publication.get("eprint_url", "N/A"), # Paper pdf link, chat GPT4 has access to internet, so it should be able to access it if necessary
                 })
                 #time.sleep(5) # We add a delay to avoid anti-scraping mechanisms from Google scholar
-        except StopIteration:
-            
-            break
-        except Exception as e:
-            
-            continue
+    finally:
+        stop.set() # Let the background thread finish
 
     #st.write(f"\nChecked {num_checked} papers to find {len(results)} that meet the criteria.")
     return results
 
-# Function to save results to CSV to provide context to GPT in the input
-def save_to_csv(results, file_name):
-    if not results:
-        st.write("No results to save.")
-        return
+# Function to fetch the news and/or papers at the same time and build the context given to GPT. What a failed source found
+# before failing is used but not cached, the run only fails when every source failed without results, and is tried again
+def fetch_context(query, source, num_needed):
+    sources = ["news", "papers"] if source == "both" else [source]
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        futures = {name: executor.submit(contextvars.copy_context().run, fetch_papers if name == "papers" else fetch_news, query, num_needed) for name in sources}
 
-    keys = results[0].keys()
+    found = {}
+    errors = []
+    for name, future in futures.items():
+        try:
+            found[name] = future.result()
+        except FetchError as e:
+            found[name] = e.results
+            errors.append(e)
+    if len(errors) == len(sources) and not any(found.values()):
+        raise errors[0]
+
+    results = []
+    contexts = []
+    if "news" in found:
+        news = found["news"]
+        results += news
+        contexts.append("\n".join([f"Title: {n['Title']}\nSource: {n['Source']}\nLink: {n['Link']}" for n in news]))
+    if "papers" in found:
+        papers = found["papers"]
+        results += papers
+        contexts.append("\n".join([f"Title: {p['Title']}\nAbstract: {p['Abstract']}\nLink: {p['Link']}" for p in papers]))
+    return results, "\n".join(context for context in contexts if context)
+
+# Function to write the results to a CSV file
+def write_csv(results, file_name):
+    keys = list(dict.fromkeys(key for result in results for key in result)) # News and papers have different columns
     with open(file_name, "w", newline="", encoding="utf-8") as file:
         writer = csv.DictWriter(file, fieldnames=keys)
         writer.writeheader()
         writer.writerows(results)
-    st.write(f"Results saved to {file_name}")
-    st.download_button(
-        label="Download Results",
-        data=open(file_name, "rb").read(),
-        file_name=file_name,
-        mime="text/csv"
-    )
-
 
-# Function to generate GPT-based summary
-def generate_summary(context, query, number_of_scenes, word_limit):
+# Function to generate GPT-based summary, with on_scene every scene is handed over as soon as its narration is written
+@traced("generate_summary")
+def generate_summary(context, query, number_of_scenes, word_limit, on_scene=None):
     prompt = (
         f"You are a scriptwriter tasked with creating a narrated video script. The video will educate viewers about '{query}'. "
         f"Use the provided context below to create a series of {number_of_scenes} scenes with descriptive visuals and accompanying narration according following instructions: "
@@ -158,15 +929,40 @@ def generate_summary(context, query, number_of_scenes, word_limit):
         # f"Now, generate a narrated video script for '{query}' in the specified format."
     )
 
+    media_cache = get_media_cache()
+    key = media_cache.key("script", prompt, model=SCRIPT_MODEL)
+    cached_script = media_cache.get_text(key)
+    if cached_script is not None:
+        if on_scene:
+            parser = ScriptStreamParser(on_scene)
+            parser.feed(cached_script)
+            parser.close()
+        return cached_script
+
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are a scriptwriter and video producer, skilled at creating narrated video scenes for educational purposes."},
-                {"role": "user", "content": prompt}
-            ]
-        )
-        return response.choices[0].message.content.strip()
+        with trace_wait(api_call=True):
+            response = get_rate_limiter("openai").call(
+                get_openai_client(openai_key).chat.completions.create,
+                model=SCRIPT_MODEL,
+                messages=[
+                    {"role": "system", "content": "You are a scriptwriter and video producer, skilled at creating narrated video scenes for educational purposes."},
+                    {"role": "user", "content": prompt}
+                ],
+                stream=on_scene is not None,
+            )
+            if on_scene:
+                parser = ScriptStreamParser(on_scene)
+                for chunk in response:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parser.feed(chunk.choices[0].delta.content)
+                parser.close()
+                script = parser.text.strip()
+            else:
+                script = response.choices[0].message.content.strip()
+        scenes = parse_prompts_video(script)
+        if scenes and len(scenes) == len(parse_prompts_voice(script)): # A script that cannot be split into scenes must not be reused
+            media_cache.put_text(key, script)
+        return script
     except Exception as e:
         st.error(f"Error with OpenAI API: {e}")
         return f"Error generating video scenes: {e}"
@@ -186,140 +982,645 @@ def parse_prompts_voice(summary):
     narrators = re.findall(narrator_pattern, summary)
     return narrators
 
+# Class to find the scene and narrator pairs of a script while GPT is still writing it
+class ScriptStreamParser:
+    def __init__(self, on_scene):
+        self.on_scene = on_scene
+        self.text = ""
+        self.parsed_until = 0 # Only complete lines are parsed, a line can arrive split in several chunks
+        self.scenes = []
+        self.narrators = []
+        self.dispatched = 0
+
+    def feed(self, chunk):
+        self.text += chunk
+        line_end = self.text.rfind("\n") + 1
+        if line_end > self.parsed_until:
+            self.parse(self.text[self.parsed_until:line_end])
+            self.parsed_until = line_end
+
+    # Parse the last line, the script does not always end with a newline
+    def close(self):
+        if self.parsed_until < len(self.text):
+            self.parse(self.text[self.parsed_until:])
+            self.parsed_until = len(self.text)
+
+    # Hand over every scene that already has both its description and its narration
+    def parse(self, lines):
+        self.scenes += parse_prompts_video(lines + "\n")
+        self.narrators += parse_prompts_voice(lines)
+        while self.dispatched < min(len(self.scenes), len(self.narrators)):
+            self.on_scene(self.dispatched, self.scenes[self.dispatched], self.narrators[self.dispatched])
+            self.dispatched += 1
+
 # Function to generate voice-over
+@traced("generate_voice_segment")
 def generate_voice_segment(prompt):
-    response = Resemble.v2.clips.create_sync(project_uuid, voice_uuid, prompt)
-    file_name = f"voice_{int(time.time())}.mp3"
+    media_cache = get_media_cache()
+    key = media_cache.key("voice", prompt, voice_uuid=voice_uuid)
+    cached_file = media_cache.get(key, ".mp3")
+    if cached_file:
+        return cached_file
+
+    from resemble import Resemble
+    project_uuid = get_resemble_project(resemble_key)
+
+    # Same request as Resemble.v2.clips.create_sync, which hides the status and the Retry-After header of a throttled call
+    def create_clip():
+        response = get_http_session().post(
+            Resemble.endpoint("v2", f"projects/{project_uuid}/clips"),
+            headers={"Content-Type": "application/json", "Authorization": f"Token token={resemble_key}"},
+            json={"voice_uuid": voice_uuid, "body": prompt},
+            timeout=(10, 300),
+        )
+        response.raise_for_status()
+        return response.json()
+
+    with trace_wait(api_call=True):
+        response = get_rate_limiter("resemble").call(create_clip, idempotent=False)
+    file_name = scratch_file("voice", ".mp3") # Unique name, several scenes can finish their narration in the same second
     #st.write("API Response:", response)
     audio_src = response['item'].get('audio_src')
     if audio_src:
-        audio_data = requests.get(audio_src).content
-        with open(file_name, 'wb') as f:
-            f.write(audio_data)
-        return file_name
+        with trace_wait():
+            download_file(audio_src, file_name)
+        return media_cache.put(key, ".mp3", file_name)
     else:
         raise ValueError("Failed to generate voice segment")
 
 # Funtion to get images to improve video quality
 def get_images(query):
   url = f'https://www.googleapis.com/customsearch/v1?q={query}&cx={cse_id}&searchType=image&key={api_key}'
-  response = requests.get(url)
-  data = response.json()
+  def search():
+    response = get_http_session().get(url, timeout=(10, 60))
+    response.raise_for_status()
+    return response.json()
+  data = get_rate_limiter("google").call(search)
 
   # Display the first image URL from the response
   # image_url = data['items'][random.randint(1, 10)]['link']
   return data['items']
 
+# Class to poll many LumaAI generations at once from a single asyncio loop running in the background
+class LumaPoller:
+    def __init__(self, auth_token, min_interval=2, max_interval=30, max_errors=5):
+        self.auth_token = auth_token
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_errors = max_errors
+        self.completion_times = collections.deque(maxlen=20) # Seconds that the last generations took to complete, used to guess when the next ones will be ready
+        self.client = None
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    # Start tracking a generation, the returned future gives the final generation (with its assets) or the failure
+    def track(self, generation_id, progress=st.write):
+        return asyncio.run_coroutine_threadsafe(self.wait(generation_id, progress, current_span.get()), self.loop)
+
+    # Seconds to wait before the next poll of a generation that has been dreaming for elapsed seconds
+    def next_delay(self, elapsed, attempt):
+        if self.completion_times:
+            recent = sorted(self.completion_times)
+            expected = recent[len(recent) // 2]
+            if elapsed < expected:
+                return max(self.min_interval, expected - elapsed) # Nothing to see until the usual completion time
+        return min(self.max_interval, self.min_interval * 1.5 ** attempt) # Late or no history yet, back off progressively
+
+    async def wait(self, generation_id, progress, span=None):
+        if self.client is None:
+            from lumaai import AsyncLumaAI
+            self.client = AsyncLumaAI(auth_token=self.auth_token, max_retries=0) # Created inside the loop so its connections belong to it
+        start = time.time()
+        attempt = 0
+        errors = 0
+        while True:
+            try:
+                trace_add("api_calls", span=span) # The loop runs in its own thread, the stage that asked for the generation is passed along
+                generation = await get_rate_limiter("luma").call_async(self.client.generations.get, id=generation_id)
+                errors = 0
+            except Exception as e:
+                errors += 1
+                if errors >= self.max_errors:
+                    raise RuntimeError(f"Could not poll generation {generation_id}: {e}")
+                generation = None
+            if generation is not None:
+                if generation.state == "completed":
+                    self.completion_times.append(time.time() - start)
+                    return generation
+                if generation.state == "failed":
+                    raise RuntimeError(f"Generation failed: {generation.failure_reason}")
+                progress("Dreaming")
+            await asyncio.sleep(self.next_delay(time.time() - start, attempt))
+            attempt += 1
+
+# Function to get a single poller per LumaAI key, shared by every scene and every session
+@st.cache_resource
+def get_luma_poller(auth_token):
+    return LumaPoller(auth_token)
+
 # Funtion to generate video
-def generate_video_segment(prompt, number, prompt_image=None):
-    ids = []
-
-    while number > 0:
-        completed = False
-        generation = client_luma.generations.create(
-            prompt=prompt,
-            loop=True,
-            aspect_ratio="16:9",
-        )
-        ids.append(generation.id)
-        st.write("Luma generation")
-        while not completed:
-            generation = client_luma.generations.get(id=generation.id)
-            if generation.state == "completed":
-                completed = True
-            elif generation.state == "failed":
-                raise RuntimeError(f"Generation failed: {generation.failure_reason}")
-            st.write("Dreaming")
-            time.sleep(5)
-        number -= 1
-
-    downloaded_files = []
-    output_file = f"{time.time()}.mp4"
-
-    # Combine video parts to return them as an output
-    for video_id in ids:
+@traced("generate_video_segment")
+def generate_video_segment(prompt, number, prompt_image=None, progress=st.write, generation_ids=None, on_generation=None):
+    # Every clip of the scene is cached on its own, so a longer narration only needs the extra clips
+    media_cache = get_media_cache()
+    keys = [media_cache.key("video", prompt, part=part, loop=True, aspect_ratio=VIDEO_ASPECT_RATIO) for part in range(number)]
+    video_files = [media_cache.get(key, ".mp4") for key in keys]
+    missing = [part for part, video_file in enumerate(video_files) if video_file is None]
+    if not missing:
+        progress("Video reused from cache")
+        return video_files
+
+    # Submit every missing generation of the scene up front so LumaAI dreams them in parallel
+    luma_poller = get_luma_poller(lumaai_key)
+    generation_ids = generation_ids or []
+    futures = {}
+    for part in missing:
+        generation_id = generation_ids[part] if part < len(generation_ids) else None
+        if generation_id:
+            progress("Resuming Luma generation") # Submitted by a previous attempt, no need to pay for it again
+        else:
+            with trace_wait(api_call=True):
+                generation = get_rate_limiter("luma").call(
+                    get_luma_client(lumaai_key).generations.create,
+                    prompt=prompt,
+                    loop=True,
+                    aspect_ratio=VIDEO_ASPECT_RATIO,
+                    idempotent=False,
+                )
+            generation_id = generation.id
+            if on_generation:
+                on_generation(part, generation_id)
+            progress("Luma generation")
+        futures[part] = luma_poller.track(generation_id, progress)
+
+    # Download every part as soon as it is ready, the parts of the scene are downloaded in parallel
+    def fetch_part(part, future):
         try:
-            video_url = client_luma.generations.get(id=video_id).assets.video
-            response = requests.get(video_url, stream=True)
-            filename = f"{video_id}.mp4"
-            with open(filename, 'wb') as file:
-                file.write(response.content)
-                st.session_state.partial_video_files.append(filename)  # Save to session state
-                st.write(f"Video {video_id} created as {filename}")
+            generation = future.result()
+        except Exception:
+            if on_generation:
+                on_generation(part, None) # Forget the failed generation so the next attempt creates a new one
+            raise
+        video_id = generation.id
+        filename = scratch_file(video_id, ".mp4")
+        download_file(generation.assets.video, filename) # The URL is already known from the last poll, no need to ask for it again
+        progress(f"Video {video_id} created as {filename}")
+        return media_cache.put(keys[part], ".mp4", filename)
+
+    with trace_wait(), ThreadPoolExecutor(max_workers=len(futures)) as executor:
+        downloads = {part: executor.submit(contextvars.copy_context().run, fetch_part, part, future) for part, future in futures.items()}
+
+    # A failed generation does not stop the poller from finishing its siblings
+    failures = []
+    for part, download in downloads.items():
+        try:
+            video_files[part] = download.result()
         except Exception as e:
-            st.error(f"Error processing video {video_id}: {e}")
+            failures.append(str(e))
+    if failures:
+        raise RuntimeError("; ".join(failures))
 
-    try:
-        video_clips = [VideoFileClip(video) for video in st.session_state.partial_video_files]
-        combined_video = concatenate_videoclips(video_clips, method="compose")
-        combined_video.write_videofile(output_file, codec="libx264", audio_codec="aac")
-        st.write(f"Videos concatenated into {output_file}")
-    except Exception as e:
-        st.error(f"Error combining video segments: {e}")
+    return video_files
 
-    return output_file
+# Function to choose how many LumaAI clips a narration needs, asking for another clip only when the stretch of the others would exceed the quality limits
+def plan_generations(narration_seconds, clip_seconds=LUMA_CLIP_SECONDS, method=FIT_METHOD, max_loops=FIT_MAX_LOOPS, max_slowdown=FIT_MAX_SLOWDOWN):
+    max_stretch = max_slowdown * (1 if method == "retime" else max_loops)
+    return max(1, math.ceil(narration_seconds / (clip_seconds * max_stretch) - 1e-6))
 
+# Function to choose how many times a scene video is played and how much it is slowed down to last as long as its narration
+def plan_fit(video_seconds, narration_seconds, method=FIT_METHOD, max_loops=FIT_MAX_LOOPS, max_slowdown=FIT_MAX_SLOWDOWN):
+    needed = narration_seconds / video_seconds
+    if needed <= 1:
+        return 1, 1.0
+    repeats = 1 if method == "retime" else min(max_loops, math.ceil(needed / max_slowdown - 1e-6))
+    # Never faster than the original, the extra part of the last loop is cut where the narration ends, and if the clips are
+    # shorter than expected the last frame is held for the rest of the narration
+    return repeats, max(1.0, min(max_slowdown, needed / repeats))
 
-# Function to add subtitles
-#def annotate(clip, txt, txt_color='white', fontsize=50, font='Helvetica-Bold', max_width=1):
-#    max_width_px = clip.size[0] * max_width
-#    # Wrap the text into multiple lines based on the max width
-#    wrapped_text = textwrap.fill(txt, width=50)  # 50 characters per line as an example, adjust based on actual font
-#    txtclip = editor.TextClip(wrapped_text, fontsize=fontsize, font=font, color=txt_color, stroke_color='black', stroke_width=1)
-#    # Composite the text on top of the video clip
-#    cvc = editor.CompositeVideoClip([clip, txtclip.set_pos(('center', 'bottom'))])
-#
-#    return cvc.set_duration(clip.duration)
+# Function to generate the narration and the video of a single scene, skipping what a previous attempt of the run already produced
+def generate_scene(narrator, scene, progress=st.write, run_state=None, index=None):
+    current_scene.set(index) # Every stage below is traced as part of this scene
+    saved = run_state.data["scenes"][index] if run_state else {}
+    voice_file = saved.get("voice_file")
+    video_files = saved.get("video_files")
+    if voice_file and video_files and all(os.path.exists(file_name) for file_name in [voice_file] + video_files):
+        progress("Scene restored from the previous run")
+        return voice_file, video_files
 
-# Function to combine video, voice and subtitles
-def combine_segments(video_files, voice_files, output_file):
-    try:
-        clips = []
-        video_clips = [VideoFileClip(video) for video in video_files]
-        for video_clip, audio, in zip(video_clips, voice_files):
-            audio_clip = AudioFileClip(audio)
-            video_clip = video_clip.set_audio(audio_clip)
-            clips.append(video_clip)
-
-        combined_video = concatenate_videoclips(clips)
-        combined_video.write_videofile(output_file, codec="libx264", audio_codec="aac")
-        
-        # Log file creation step
-        #st.write(f"Tried creating {output_file}")
-        #absolute_path = os.path.abspath(output_file)
-        #st.write(f"Absolute path: {absolute_path}")
-        #st.write(f"File exists after creation: {os.path.exists(absolute_path)}")
-    except Exception as e:
-        st.write(f"Error in combine_segments: {e}")
+    if not (voice_file and os.path.exists(voice_file)):
+        voice_file = generate_voice_segment(narrator)
+        if run_state:
+            voice_file = run_state.keep(voice_file, f"scene_{index}_voice.mp3")
+            run_state.update_scene(index, voice_file=voice_file)
+    progress("Audio generated")
+    narration_seconds = probe_media(voice_file)["duration"]
+    length = plan_generations(narration_seconds) # The clips are looped or slowed down locally to cover the rest of the narration
+    generations_saved = int(narration_seconds / LUMA_CLIP_SECONDS) + 1 - length # Clips needed to cover the narration without fitting
+    video_prompt = scene + '\n' + CAMERA_INSTRUCTIONS
+    on_generation = (lambda part, generation_id: run_state.update_generation(index, part, generation_id)) if run_state else None
+    video_files = generate_video_segment(video_prompt, length, progress=progress, generation_ids=saved.get("luma_ids"), on_generation=on_generation)
+    if run_state:
+        video_files = [run_state.keep(video_file, f"scene_{index}_part_{part}.mp4") for part, video_file in enumerate(video_files)]
+        run_state.update_scene(index, video_files=video_files, generations_saved=generations_saved)
+    progress("Video generated")
+    return voice_file, video_files
 
-    return output_file
+# Class to generate all the scenes concurrently, so the total time is close to the one of the slowest scene instead of the sum of all of them
+class SceneScheduler:
+    def __init__(self, max_workers=3, report=None, run_state=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.run_state = run_state
+        self.futures = {}
+        self.messages = queue.Queue() # Worker threads cannot write to Streamlit, so they leave their progress here for the main thread
+        self.placeholders = {}
+        self.report = report or self.show_in_placeholder
+
+    # Queue a scene, it starts as soon as a worker is free
+    def submit(self, index, narrator, scene):
+        progress = lambda message: self.messages.put((index, message))
+        self.futures[index] = self.executor.submit(contextvars.copy_context().run, generate_scene, narrator, scene, progress, self.run_state, index)
+
+    # Report the messages left by the workers since the last call
+    def show_progress(self):
+        while True:
+            try:
+                index, message = self.messages.get_nowait()
+            except queue.Empty:
+                return
+            self.report(index, message)
+
+    # Show the latest message of every scene in its own placeholder
+    def show_in_placeholder(self, index, message):
+        if index not in self.placeholders:
+            self.placeholders[index] = st.empty()
+        self.placeholders[index].write(f"Scene {index}: {message}")
+
+    # Wait for every scene and return the (voice file, video parts) pairs in scene order
+    def results(self):
+        while not all(future.done() for future in self.futures.values()):
+            self.show_progress()
+            time.sleep(0.5)
+        self.show_progress()
+        self.executor.shutdown()
+
+        results = []
+        errors = []
+        for index in sorted(self.futures):
+            try:
+                results.append(self.futures[index].result())
+            except Exception as e:
+                errors.append(f"scene {index}: {e}") # Let the other scenes finish, their generations are already paid
+        if errors:
+            raise RuntimeError("Scene generation failed for " + "; ".join(errors))
+        return results
+
+
+# Function to split the narrations into subtitle cues, each narration is spread over its measured duration in proportion to the length of its lines
+def build_cues(narrators, narration_durations, scene_durations, line_width=SUBTITLE_LINE_WIDTH, max_lines=2):
+    cues = []
+    scene_start = 0.0
+    for narrator, narration_seconds, scene_seconds in zip(narrators, narration_durations, scene_durations):
+        lines = textwrap.wrap(narrator, width=line_width)
+        chunks = ["\n".join(lines[index:index + max_lines]) for index in range(0, len(lines), max_lines)]
+        total = sum(len(chunk) for chunk in chunks)
+        start = scene_start
+        for chunk in chunks:
+            end = start + narration_seconds * len(chunk) / total
+            cues.append((start, end, chunk))
+            start = end
+        scene_start += scene_seconds # The narration starts with its scene, the rest of a longer scene has no subtitles
+    return cues
+
+# Function to write subtitle cues as SRT (for the video file) or WebVTT (for the browser), depending on the extension
+def write_subtitles(cues, file_name):
+    webvtt = file_name.endswith(".vtt")
+    separator = "." if webvtt else ","
+
+    def timestamp(seconds):
+        minutes, milliseconds = divmod(round(seconds * 1000), 60000)
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours:02d}:{minutes:02d}:{milliseconds // 1000:02d}{separator}{milliseconds % 1000:03d}"
+
+    with open(file_name, "w", encoding="utf-8") as file:
+        if webvtt:
+            file.write("WEBVTT\n\n")
+        for number, (start, end, text) in enumerate(cues, start=1):
+            if not webvtt:
+                file.write(f"{number}\n")
+            file.write(f"{timestamp(start)} --> {timestamp(end)}\n{text}\n\n")
+    return file_name
+
+# Function to read the duration and the streams of a media file
+def probe_media(file_name):
+    result = subprocess.run(
+        [FFPROBE_BINARY, "-v", "error", "-show_entries", "format=duration:stream=codec_type,codec_name,width,height,pix_fmt,r_frame_rate", "-of", "json", file_name],
+        capture_output=True, text=True, check=True,
+    )
+    info = json.loads(result.stdout)
+    video_streams = [stream for stream in info["streams"] if stream["codec_type"] == "video"]
+    return {
+        "duration": float(info["format"]["duration"]),
+        "video": video_streams[0] if video_streams else None,
+    }
+
+# Function to run ffmpeg and show its own error message if it fails
+def run_ffmpeg(arguments):
+    start = time.time()
+    result = subprocess.run([FFMPEG_BINARY, "-y", "-hide_banner", "-loglevel", "error"] + arguments, capture_output=True, text=True)
+    trace_add("encode", time.time() - start)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.strip()[-2000:]}")
+
+# Function to get a hash of the content of a file, remembered while the file does not change
+def file_digest(file_name):
+    stat = os.stat(file_name)
+    return hash_file(os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)
 
-# Function to add music to a video
-def add_BGM(music, video, output_file, music_volume=0.3):
-    # Load the video clip and extract the original audio
-    video_clip = VideoFileClip(video)
-    original_audio = video_clip.audio
+@functools.lru_cache(maxsize=4096)
+def hash_file(file_name, size, modified):
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as file:
+        for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-    # Load the background music and adjust its volume
-    bgm = AudioFileClip(music).volumex(music_volume)
+# Function to decide how the scenes are combined: how every scene video is stretched to its narration and the format every scene is encoded to
+def plan_composition(scene_parts, voice_files, fit_method=FIT_METHOD, max_loops=FIT_MAX_LOOPS, max_slowdown=FIT_MAX_SLOWDOWN):
+    parts = [part for parts in scene_parts for part in parts]
+    media_infos = {file_name: probe_media(file_name) for file_name in set(parts + voice_files)}
+    reference = media_infos[parts[0]]["video"] # Every scene is encoded with the size and frame rate of the first LumaAI part
+    frame_rate = fractions.Fraction(reference["r_frame_rate"])
 
-    # Ensure both audios have the same duration (either trim the BGM or loop it)
-    if bgm.duration > video_clip.duration:
-        bgm = bgm.subclip(0, video_clip.duration)  # Trim BGM if it's longer than the video
-    elif bgm.duration < video_clip.duration:
-        bgm = bgm.loop(duration=video_clip.duration)  # Loop BGM if it's shorter than the video
+    # Stretch every scene video shorter than its narration by looping and slowing it down instead of asking LumaAI for more clips
+    fits = []
+    for parts_of_scene, voice_file in zip(scene_parts, voice_files):
+        video_seconds = sum(media_infos[part]["duration"] for part in parts_of_scene)
+        narration_seconds = media_infos[voice_file]["duration"]
+        repeats, slowdown = plan_fit(video_seconds, narration_seconds, fit_method, max_loops, max_slowdown)
+        stretched = video_seconds * repeats * slowdown
+        duration = narration_seconds if repeats > 1 else max(stretched, narration_seconds) # The last loop is cut where the narration ends
+        duration = float(math.ceil(duration * frame_rate - 0.001) / frame_rate) # Whole frames, so the joined scenes do not drift from the subtitles
+        fits.append((repeats, slowdown, stretched, duration))
 
-    # Mix the original audio with the background music (using CompositeAudioClip)
-    final_audio = CompositeAudioClip([original_audio, bgm])
+    return {"media_infos": media_infos, "fits": fits, "fit_method": fit_method, "width": reference["width"], "height": reference["height"], "frame_rate": reference["r_frame_rate"]}
 
-    # Set the final audio to the video
-    video_clip = video_clip.set_audio(final_audio)
+# Function to describe the segment of every scene, its cache key only changes when something that changes its encode changes
+def plan_segments(scene_parts, voice_files, plan, preview=False, burned_narrators=None):
+    width, height, frame_rate = plan["width"], plan["height"], plan["frame_rate"]
+    if preview and height > PREVIEW_HEIGHT:
+        width, height = round(width * PREVIEW_HEIGHT / height / 2) * 2, PREVIEW_HEIGHT # libx264 needs even sizes
+    if preview:
+        frame_rate = PREVIEW_FRAME_RATE
 
-    # Write the final video with background music
-    video_clip.write_videofile(output_file, codec="libx264", audio_codec="aac")
+    media_cache = get_media_cache()
+    segments = []
+    for index, (parts, voice_file, fit) in enumerate(zip(scene_parts, voice_files, plan["fits"])):
+        segment = {
+            "fit": fit,
+            "fit_method": plan["fit_method"],
+            "narration_seconds": plan["media_infos"][voice_file]["duration"],
+            "narrator": burned_narrators[index] if burned_narrators else None, # Text burned into the segment
+            "width": width,
+            "height": height,
+            "frame_rate": frame_rate,
+            "encode": PREVIEW_VIDEO_ENCODE if preview else VIDEO_ENCODE,
+            "audio_bitrate": "96k" if preview else "192k",
+        }
+        segment["key"] = media_cache.key("segment", "", parts=[file_digest(part) for part in parts], voice=file_digest(voice_file), **segment)
+        segment.update(parts=parts, voice_file=voice_file)
+        segments.append(segment)
+    return segments
 
+# Function to encode a scene into a segment with the same codec, size, frame rate and audio layout as the others, with its narration,
+# so the segments are joined without encoding them again and a scene that did not change is never encoded twice
+@traced("render_segment")
+def render_segment(segment):
+    media_cache = get_media_cache()
+    cached_file = media_cache.get(segment["key"], ".mp4")
+    if cached_file:
+        return cached_file
+
+    width, height, frame_rate = segment["width"], segment["height"], segment["frame_rate"]
+    repeats, slowdown, stretched, duration = segment["fit"]
+    inputs = []
+    filters = []
+    labels = []
+    for repeat in range(repeats):
+        backwards = segment["fit_method"] == "pingpong" and repeat % 2 == 1 # Every other pass is played backwards, reverse keeps the whole part in memory
+        for part in (reversed(segment["parts"]) if backwards else segment["parts"]):
+            index = len(labels)
+            inputs += ["-i", part] # A looped part is read again instead of kept in memory
+            labels.append(f"[v{index}]")
+            filters.append(f"[{index}:v]scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={frame_rate},format=yuv420p{',reverse' if backwards else ''}[v{index}]")
+    fitting = [f"concat=n={len(labels)}:v=1:a=0"]
+    if slowdown != 1:
+        fitting.append(f"setpts={slowdown:.4f}*PTS,fps={frame_rate}")
+    if duration - stretched > 0.001:
+        fitting.append(f"tpad=stop_mode=clone:stop_duration={duration - stretched:.3f}")
+    fitting.append(f"trim=duration={duration:.3f}")
+    if segment["narrator"]:
+        subtitle_file = write_subtitles(build_cues([segment["narrator"]], [segment["narration_seconds"]], [duration]), scratch_file("subtitles", ".srt"))
+        escaped = os.path.abspath(subtitle_file).replace("\\", "/").replace(":", "\\:") # Colons separate the options of a filter
+        fitting.append(f"subtitles='{escaped}'")
+    filters.append("".join(labels) + ",".join(fitting) + "[video]")
+
+    # Pad or cut the narration to the scene
+    filters.append(f"[{len(labels)}:a]aresample=44100,aformat=channel_layouts=stereo,apad,atrim=0:{duration:.3f}[audio]")
+    inputs += ["-i", segment["voice_file"]]
+
+    encoded_file = scratch_file("segment", ".mp4")
+    run_ffmpeg(
+        inputs
+        + ["-filter_complex", ";".join(filters), "-map", "[video]", "-map", "[audio]"]
+        + segment["encode"]
+        + ["-c:a", "aac", "-b:a", segment["audio_bitrate"], "-t", f"{duration:.3f}", encoded_file]
+    )
+    return media_cache.put(segment["key"], ".mp4", encoded_file)
+
+# Function to combine the scenes and the background music: every scene is encoded once into its own segment, then the segments are
+# joined without encoding the video again and only the audio is encoded to mix in the music, a preview is encoded small and fast
+@traced("compose_video")
+def compose_video(scene_parts, voice_files, output_file, music=None, music_volume=0.3, preview=False, plan=None, subtitles=None, burned_narrators=None):
+    plan = plan or plan_composition(scene_parts, voice_files)
+    segments = plan_segments(scene_parts, voice_files, plan, preview, burned_narrators)
+
+    def render(index, segment):
+        current_scene.set(index) # Every segment is traced as part of its scene
+        return render_segment(segment)
+
+    # Scenes with the same inputs share their segment, it is encoded once
+    unique = {}
+    for index, segment in enumerate(segments):
+        unique.setdefault(segment["key"], (index, segment))
+    with ThreadPoolExecutor(max_workers=SEGMENT_WORKERS) as executor:
+        futures = {key: executor.submit(contextvars.copy_context().run, render, index, segment) for key, (index, segment) in unique.items()}
+    segment_files = [futures[segment["key"]].result() for segment in segments]
+
+    list_file = scratch_file("concat", ".txt")
+    with open(list_file, "w", encoding="utf-8") as file:
+        file.writelines(f"file '{os.path.abspath(segment_file)}'\n" for segment_file in segment_files)
+    inputs = ["-f", "concat", "-safe", "0", "-i", list_file]
+    filters = []
+    audio_output = "0:a"
+    audio_codec = ["-c:a", "copy"]
+
+    # Loop the background music and lower it further while the narrator speaks
+    if music:
+        inputs += ["-stream_loop", "-1", "-i", music]
+        filters += [
+            "[0:a]asplit[voice][sidechain]",
+            f"[1:a]aresample=44100,aformat=channel_layouts=stereo,volume={music_volume}[music]",
+            "[music][sidechain]sidechaincompress=threshold=0.05:ratio=8:attack=20:release=400[ducked]",
+            "[voice][ducked]amix=inputs=2:duration=first:dropout_transition=0,volume=2[mix]", # amix halves both inputs, volume=2 keeps the original levels
+        ]
+        audio_output = "[mix]"
+        audio_codec = ["-c:a", "aac", "-b:a", "96k" if preview else "192k"]
+
+    # Subtitles not burned are added as a track that players can turn on and off, nothing is encoded for them
+    subtitle_track = []
+    if subtitles:
+        subtitle_track = ["-map", f"{inputs.count('-i')}:s", "-c:s", "mov_text", "-metadata:s:s:0", "language=eng"]
+        inputs += ["-i", subtitles]
+
+    try:
+        run_ffmpeg(
+            inputs
+            + (["-filter_complex", ";".join(filters)] if filters else [])
+            + ["-map", "0:v", "-map", audio_output, "-c:v", "copy"]
+            + audio_codec
+            + subtitle_track
+            + ["-t", f"{sum(duration for _, _, _, duration in plan['fits']):.3f}"]
+            + ["-movflags", "+faststart", output_file] # Index at the start of the file, the browser starts playing before downloading all of it
+        )
+    finally:
+        os.remove(list_file)
     return output_file
 
+# Function to run every stage of a run, each stage is skipped if a previous attempt of the run already completed it
+def run_pipeline(run_state, max_concurrent_scenes=3, progress=st.write, report=None, stream_script=True, preview=False, subtitles="soft"):
+    collect_runs(os.path.dirname(run_state.run_dir), skip=run_state.run_dir) # Make room for this run by cleaning up the old ones in the same folder
+    if not run_state.claim():
+        progress("Another session is generating this video, waiting for it to finish...")
+        run_state.fresh = False # Continue from what the other session produced instead of starting again
+        while not run_state.claim():
+            time.sleep(RUN_WAIT_SECONDS)
+    params = run_state.data["params"]
+    tracer = Tracer() # Timings of this attempt, written to trace.json in the run folder
+    tracer_token = current_tracer.set(tracer)
+    attempt_dir = os.path.join(run_state.scratch_dir, uuid.uuid4().hex) # Removed when the attempt ends, never while another attempt of the run uses its own
+    scratch_token = current_scratch_dir.set(attempt_dir)
+    try:
+        run_state.update(status="running", error=None)
+        if run_state.data["context"] is None:
+            progress({"papers": "Fetching academic papers...", "news": "Fetching news articles..."}.get(params["source"], "Fetching news articles and academic papers..."))
+            results, context = fetch_context(params["query"], params["source"], params["num_needed"])
+            context_file = None
+            if results:
+                context_file = os.path.join(run_state.run_dir, f"{params['source']}_results.csv")
+                write_csv(results, context_file)
+            run_state.update(context=context, context_file=context_file)
+        else:
+            progress("Context restored from the previous run")
+
+        scheduler = SceneScheduler(max_workers=max_concurrent_scenes, report=report, run_state=run_state)
+        if run_state.data["script"] is None:
+            # Start every scene as soon as GPT has written it, LumaAI takes minutes per clip so there is no reason to wait for the whole script
+            def dispatch_scene(index, scene, narrator):
+                run_state.add_scene(scene, narrator)
+                scheduler.submit(index, narrator, scene)
+                scheduler.show_progress()
+
+            run_state.update(scenes=[])
+            script = generate_summary(run_state.data["context"], params["query"], params["scenes"], params["word_limit"], on_scene=dispatch_scene if stream_script else None)
+            scenes = parse_prompts_video(script)
+            narrators = parse_prompts_voice(script)
+            if not scenes or len(scenes) != len(narrators):
+                if scheduler.futures:
+                    try:
+                        scheduler.results() # Let the scenes already started finish, their generations are cached for the next attempt
+                    except Exception as e:
+                        progress(str(e)) # The mismatch below is what fails the run, the scenes are written again by the next attempt
+                run_state.update(scenes=[])
+                raise ValueError("Mismatch between number of scenes and narrators") # The script is not saved, the next attempt writes a new one
+            if not stream_script:
+                run_state.update(scenes=[{"scene": scene, "narrator": narrator} for scene, narrator in zip(scenes, narrators)])
+            run_state.update(script=script)
+        progress("Summary:")
+        progress(run_state.data["script"])
+
+        for index, saved in enumerate(run_state.data["scenes"]): # Generate audio and video for each narrator-scene pair not started yet
+            if index not in scheduler.futures:
+                scheduler.submit(index, saved["narrator"], saved["scene"])
+        scene_results = scheduler.results()
+
+        generations_saved = sum(saved.get("generations_saved", 0) for saved in run_state.data["scenes"])
+        progress(f"LumaAI generations saved by fitting the clips to the narrations: {generations_saved}")
+        run_state.update(generations_saved=generations_saved)
+
+        final_video = run_state.data["final_video"]
+        if not (final_video and os.path.exists(final_video) and run_state.data.get("final_subtitles") == subtitles):
+            scene_parts = [video_files for _, video_files in scene_results]
+            voice_files = [voice_file for voice_file, _ in scene_results]
+            plan = plan_composition(scene_parts, voice_files)
+
+            # Time the subtitles with the measured narrations, SRT goes into the video and WebVTT to the browser
+            subtitle_files = []
+            if subtitles != "off":
+                cues = build_cues(
+                    [saved["narrator"] for saved in run_state.data["scenes"]],
+                    [plan["media_infos"][voice_file]["duration"] for voice_file in voice_files],
+                    [duration for _, _, _, duration in plan["fits"]],
+                )
+                subtitle_files = [write_subtitles(cues, os.path.join(run_state.run_dir, f"subtitles{extension}")) for extension in (".srt", ".vtt")]
+            run_state.update(subtitle_files=subtitle_files)
+            subtitle_file = subtitle_files[0] if subtitles == "soft" else None
+            burned_narrators = [saved["narrator"] for saved in run_state.data["scenes"]] if subtitles == "burned" else None
+
+            media_cache = get_media_cache()
+            encoded = all(os.path.exists(media_cache.path(segment["key"], ".mp4")) for segment in plan_segments(scene_parts, voice_files, plan, burned_narrators=burned_narrators))
+            if preview and not encoded: # Joining segments already encoded is as fast as a preview
+                # The full-quality encode waits until the preview is accepted, most previews are thrown away after changing the settings
+                preview_video = run_state.data.get("preview_video")
+                if not (preview_video and os.path.exists(preview_video) and run_state.data.get("preview_subtitles") == subtitles):
+                    preview_video = os.path.join(run_state.run_dir, "preview_video.mp4")
+                    encoded_video = scratch_file("preview_video", ".mp4")
+                    compose_video(scene_parts, voice_files, encoded_video, music=BACKGROUND_MUSIC, preview=True, plan=plan, subtitles=subtitle_file, burned_narrators=burned_narrators)
+                    shutil.move(encoded_video, preview_video)
+                    run_state.update(preview_video=preview_video, preview_subtitles=subtitles)
+                run_state.update(status="previewed")
+                return preview_video
+
+            # Encode the scenes that changed and join them with the others and the background music
+            final_video = os.path.join(run_state.run_dir, "final_video.mp4")
+            encoded_video = scratch_file("final_video", ".mp4") # Moved to the run folder once complete, a failed encode never leaves a broken final video
+            compose_video(scene_parts, voice_files, encoded_video, music=BACKGROUND_MUSIC, plan=plan, subtitles=subtitle_file, burned_narrators=burned_narrators)
+            shutil.move(encoded_video, final_video)
+            run_state.update(final_video=final_video, final_subtitles=subtitles)
+        run_state.update(status="completed")
+        return final_video
+    except Exception as e:
+        run_state.update(status="failed", error=str(e))
+        raise
+    finally:
+        current_tracer.reset(tracer_token)
+        current_scratch_dir.reset(scratch_token)
+        shutil.rmtree(attempt_dir, ignore_errors=True)
+        with contextlib.suppress(OSError):
+            os.rmdir(run_state.scratch_dir) # Only when no other attempt has files in it
+        try:
+            run_state.update(trace=tracer.write(os.path.join(run_state.run_dir, "trace.json")), rate_limits=rate_limit_stats()) # The limits are shared, the counts include the other sessions
+        finally:
+            run_state.release()
+
+# Function to show a download link to a file of the run, served from disk when Streamlit static serving is enabled
+def show_download(label, file_name, mime):
+    url = publish_file(file_name)
+    if url: # The download attribute saves the file instead of opening it in a tab, whatever type Streamlit sends it as
+        st.markdown(f'<a href="{html.escape(url)}" download="{html.escape(os.path.basename(file_name))}">{html.escape(label)}</a>', unsafe_allow_html=True)
+        return
+    with open(file_name, "rb") as file: # Without static serving Streamlit keeps a copy of the file in memory
+        st.download_button(label=label, data=file, file_name=os.path.basename(file_name), mime=mime)
+
 
 # MAIN CODE
 
@@ -344,11 +1645,7 @@ def main():
             # Set the session state flag
             st.session_state.video_generation_started = True
 
-            # Reinitialize required session state variables
-            st.session_state.voice_files = []  # To store generated voice files
-            st.session_state.video_files = []  # To store generated video files
-            st.session_state.partial_video_files = []  # To store generated parts of video files by LumaAI
-            st.session_state.final_video_no_music = None  # To store the final combined video
+            # Reinitialize required session state variables, the generated files themselves are kept in the run folder
             st.session_state.final_video_music = None  # To store the final combined video with music
             st.session_state.prompts = None  # To store prompts
             st.session_state.narrators = None  # To store narrators
@@ -357,100 +1654,147 @@ def main():
     # Step 2: Input Section
     if st.session_state.video_generation_started and not st.session_state.video_generated:
         query = st.text_input("Enter your query (e.g., 'World War II in Japan'):", "")
-        option = st.radio("Choose data source:", ["news", "papers"])
+        option = st.radio("Choose data source:", ["news", "papers", "both"])
         num_needed = st.slider("Amount of papers/news to fetch:", 0, 5, 10)
         scenes_needed = st.slider("Number of scenes for the video:", 1, 5, 10)
         word_limit = st.slider("Word limit per narration:", 10, 100, 50)
+        max_concurrent_scenes = st.slider("Scenes generated at the same time:", 1, 5, 3)
+        resume_run = st.checkbox("Resume the previous run with these settings", value=True)
+        stream_script = st.checkbox("Start generating scenes while the script is being written", value=True)
+        preview = st.checkbox("Show a fast low-resolution preview before the full-quality render", value=True)
+        subtitles = st.radio("Subtitles:", ["soft", "burned", "off"], help="Soft subtitles can be turned on and off in the player, burned ones are drawn on the video")
 
         if st.button("Generate Video"):
             st.session_state.video_generated = True
+            # Keep the settings, the inputs are not shown again while the video is generated and reviewed
+            st.session_state.run_params = {"query": query, "source": option, "num_needed": num_needed, "scenes": scenes_needed, "word_limit": word_limit}
+            st.session_state.run_options = {"max_concurrent_scenes": max_concurrent_scenes, "stream_script": stream_script, "preview": preview, "subtitles": subtitles}
+            st.session_state.fresh_run = not resume_run
+            st.session_state.preview_accepted = False
             # Simulate video generation logic here
             st.write("Video is being generated...")
     
     # Step 3: Display Results
     if st.session_state.video_generated:
         st.write("Video generation started")
-        if option == "papers":
-            st.write("Fetching academic papers...")
-            papers = fetch_papers(query, num_needed)
-            save_to_csv(papers, "papers_results.csv")
-            context = "\n".join([f"Title: {p['Title']}\nAbstract: {p['Abstract']}\nLink: {p['Link']}" for p in papers])
-            st.write("Summary:")
-            st.session_state.prompts = generate_summary(context, query, scenes_needed, word_limit)
-            st.write(st.session_state.prompts)
-            st.session_state.scenes = parse_prompts_video(st.session_state.prompts)
-            st.session_state.narrators = parse_prompts_voice(st.session_state.prompts)
-    
-    
-        elif option == "news":
-            st.write("Fetching news articles...")
-            news = fetch_news(query, num_needed)
-            save_to_csv(news, "news_results.csv")
-            context = "\n".join([f"Title: {n['Title']}\nSource: {n['Source']}\nLink: {n['Link']}" for n in news])
-            st.write("Summary:")
-            st.session_state.prompts = generate_summary(context, query, scenes_needed, word_limit)
-            st.write(st.session_state.prompts)
-            st.session_state.scenes = parse_prompts_video(st.session_state.prompts)
-            st.session_state.narrators = parse_prompts_voice(st.session_state.prompts)
-    
-        if st.session_state.narrators and st.session_state.scenes:
-            if len(st.session_state.scenes) != len(st.session_state.narrators):
-                raise ValueError("Mismatch between number of scenes and narrators")
-            
-            for index, (narrator, scene) in enumerate(zip(st.session_state.narrators, st.session_state.scenes)): # Generate audio and video for each narrator-scene pair
-                name_number = index
-                voice_file = generate_voice_segment(narrator)
-                st.session_state.voice_files.append(voice_file)
-                st.write("Audio:", name_number)
-                audio = AudioSegment.from_file(voice_file)
-                length = int(len(audio) / 5000) + 1
-                video_prompt = scene + '\n' + "camera fixes, no camera movement"
-                #st.write("Video prompt: ", video_prompt)
-                st.session_state.partial_video_files = []  # Initialize partial storage of video files to avoid repetitions
-                video_file = generate_video_segment(video_prompt, length)
-                if video_file:
-                    st.session_state.video_files.append(video_file)
-                    st.write("Video:", name_number)
-                    # Read and display the generated video
-                    #with open(video_file, "rb") as video_file_a:
-                    #    video_bytes_a = video_file_a.read()
-                    #    st.video(video_bytes_a)
-                    
-                    # Access and display the video from session state
-                    #with open(st.session_state.video_files[index], "rb") as video_file_b:
-                    #    video_bytes_b = video_file_b.read()
-                    #    st.video(video_bytes_b)
-                else:
-                    st.warning(f"Video generation failed for scene:", name_number)
-        
-            # Combine the segments
-            try:
-                output_file_1 = f"final_video_no_music{time.time()}.mp4"
-                output_file_2 = f"final_video_music{time.time()}.mp4"
-                final_video_no_music = combine_segments(st.session_state.video_files, st.session_state.voice_files, output_file_1)
-                st.session_state.final_video_no_music = final_video_no_music
-        
-                # Add background music
-                final_video_music = add_BGM("bollywoodkollywood-sad-love-bgm-13349.mp3", st.session_state.final_video_no_music, output_file_2)
-                st.session_state.final_video_music = final_video_music
-        
-                if st.session_state.final_video_music and os.path.exists(st.session_state.final_video_music):
-                    with open(st.session_state.final_video_music, "rb") as video_file:
-                        video_bytes = video_file.read()
-                        st.video(video_bytes)
-        
-            except Exception as e:
-                st.write(f"Error combining video and voice segments: {e}")
-        
+        options = st.session_state.run_options
+        run_state = get_run_state(st.session_state.run_params, fresh=st.session_state.fresh_run)
+        st.session_state.fresh_run = False # The next reruns of the page continue this run
+        st.write(f"Run folder: {run_state.run_dir}")
+        try:
+            st.session_state.final_video_music = run_pipeline(
+                run_state, options["max_concurrent_scenes"], stream_script=options["stream_script"],
+                preview=options["preview"] and not st.session_state.preview_accepted, subtitles=options["subtitles"],
+            )
+        except Exception as e:
+            st.error(f"Video generation failed, generate it again with the same settings to resume it from this point: {e}")
+        finally:
+            st.session_state.prompts = run_state.data["script"]
+            st.session_state.scenes = [saved["scene"] for saved in run_state.data["scenes"]]
+            st.session_state.narrators = [saved["narrator"] for saved in run_state.data["scenes"]]
+
+        if run_state.data.get("trace"):
+            with st.expander("Timings of this run"):
+                st.json(run_state.data["trace"])
+
+        # Allow users to download the context given to GPT
+        context_file = run_state.data["context_file"]
+        if context_file and os.path.exists(context_file):
+            show_download("Download Results", context_file, "text/csv")
+
+        # The videos are served from disk, the server never holds them in memory, the soft subtitles are shown by the player
+        subtitle_files = run_state.data.get("subtitle_files") or []
+        player_subtitles = subtitle_files[1] if options["subtitles"] == "soft" and subtitle_files else None
+        if st.session_state.final_video_music and run_state.data["status"] == "previewed":
+            st.write("Preview of the video in low resolution, accept it to render the full-quality video:")
+            st.video(video_source(st.session_state.final_video_music), subtitles=player_subtitles)
+            if st.button("Accept the preview and render in full quality"):
+                st.session_state.preview_accepted = True
+                st.rerun()
+        elif st.session_state.final_video_music and os.path.exists(st.session_state.final_video_music):
+            st.video(video_source(st.session_state.final_video_music), subtitles=player_subtitles)
+
             # Allow users to download the video
-            if os.path.exists(st.session_state.final_video_music):
-                with open(st.session_state.final_video_music, "rb") as file:
-                    st.download_button(
-                        label="Download Final Video",
-                        data=file,
-                        file_name=output_file_2,
-                        mime="video/mp4"
-                    )
+            show_download("Download Final Video", st.session_state.final_video_music, "video/mp4")
+
+    # Show how much of the generation work has been reused from previous runs
+    cache_stats = get_media_cache().stats()
+    st.sidebar.caption(f"Generation cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+
+    # Show how close every provider is to its quota, for all the sessions of the server
+    for provider, stats in rate_limit_stats().items():
+        st.sidebar.caption(f"{provider}: {stats['active']} calls running, {stats['waiting']} waiting (max {stats['max_waiting']}), {stats['throttled']} throttled, {stats['retries']} retries")
+
+
+# BATCH RENDERING
+
+# Function to render a job outside Streamlit, its folder keeps the manifest and the files of every stage so a failed job is resumed
+def render_job(job, job_dir, max_concurrent_scenes=3, progress=print):
+    params = {
+        "query": job["query"],
+        "source": job.get("source", "news"),
+        "num_needed": job.get("num_needed", 5),
+        "scenes": job.get("scenes", 3),
+        "word_limit": job.get("word_limit", 50),
+    }
+    subtitles = job.get("subtitles", "soft")
+    run_state = RunState(job_dir, params)
+    if run_state.data["status"] == "completed" and run_state.data["final_video"] and os.path.exists(run_state.data["final_video"]) and run_state.data.get("final_subtitles") == subtitles:
+        progress("Already rendered")
+        return run_state.data
+
+    try:
+        final_video = run_pipeline(run_state, max_concurrent_scenes, progress, report=lambda index, message: progress(f"Scene {index}: {message}"), subtitles=subtitles)
+        progress(f"Video saved to {final_video}")
+    except Exception as e:
+        progress(f"Failed: {e}")
+    return run_state.data
+
+# Function to read the jobs of a JSONL file, one job per line
+def load_jobs(jobs_file):
+    jobs = []
+    with open(jobs_file, encoding="utf-8") as file:
+        for number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            if not job.get("query"):
+                raise ValueError(f"Job in line {number} has no query")
+            if job.get("source", "news") not in ("news", "papers", "both"):
+                raise ValueError(f"Job in line {number} has an unknown source: {job['source']}")
+            if job.get("subtitles", "soft") not in ("soft", "burned", "off"):
+                raise ValueError(f"Job in line {number} has an unknown subtitles mode: {job['subtitles']}")
+            jobs.append(job)
+    return jobs
+
+# Function to render a JSONL file of jobs from the command line with a pool of workers
+def run_batch(arguments=None):
+    parser = argparse.ArgumentParser(description="Render a batch of educational videos without the Streamlit interface.")
+    parser.add_argument("jobs_file", help="JSONL file with one job per line: query, source (news, papers or both), num_needed, scenes, word_limit and subtitles (soft, burned or off)")
+    parser.add_argument("--output-dir", default="batch_output", help="Directory where every job gets its own folder and manifest, rerunning the same jobs resumes the unfinished ones")
+    parser.add_argument("--workers", type=int, default=2, help="Jobs rendered at the same time")
+    parser.add_argument("--scene-workers", type=int, default=3, help="Scenes of a job generated at the same time")
+    arguments = parser.parse_args(arguments)
+
+    missing_keys = [name for name, value in [("OPENAI_API_KEY", openai_key), ("RESEMBLE_API_KEY", resemble_key), ("LUMAAI_API_KEY", lumaai_key)] if not value]
+    if missing_keys:
+        parser.error("Missing environment variables: " + ", ".join(missing_keys))
+
+    jobs = load_jobs(arguments.jobs_file)
+    with ThreadPoolExecutor(max_workers=arguments.workers) as executor:
+        futures = []
+        for number, job in enumerate(jobs):
+            job_name = f"job_{number:04d}"
+            progress = lambda message, job_name=job_name: print(f"[{job_name}] {message}", flush=True)
+            futures.append(executor.submit(render_job, job, os.path.join(arguments.output_dir, job_name), arguments.scene_workers, progress))
+        manifests = [future.result() for future in futures]
+
+    failed = sum(manifest["status"] != "completed" for manifest in manifests)
+    print(f"Rendered {len(manifests) - failed} of {len(manifests)} jobs, manifests in {arguments.output_dir}")
+    return 1 if failed else 0
 
 if __name__ == "__main__":
-    main()
+    if runtime.exists():
+        main()
+    else:
+        sys.exit(run_batch())
@@ -0,0 +1,347 @@
+# BENCHMARK CODE
+# Replays the whole pipeline of pbl2024_app.py against local stub OpenAI, Resemble and LumaAI servers with configurable latencies,
+# so the scheduling and encoding changes can be measured without spending credits
+
+# IMPORT LIBRARIES
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Script run in a fresh interpreter to time the first import of the app and the reruns Streamlit does on every interaction
+STARTUP_SCRIPT = """
+import json, runpy, time
+start = time.perf_counter()
+import pbl2024_app
+imported = time.perf_counter() - start
+reruns = []
+for _ in range({reruns}):
+    start = time.perf_counter()
+    runpy.run_path(pbl2024_app.__file__) # Same module code, already imported modules and cached clients, like a Streamlit rerun
+    reruns.append(time.perf_counter() - start)
+print(json.dumps({{"import": imported, "reruns": reruns}}))
+"""
+
+# DEFINE FUNCTIONS TO USE
+
+# Function to create the clip and the narration returned by the stubs
+def make_sample_media(directory, clip_seconds, narration_seconds, size):
+    ffmpeg = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+    subprocess.run(
+        [ffmpeg, "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"testsrc=size={size}:rate=24:duration={clip_seconds}",
+         "-c:v", "libx264", "-pix_fmt", "yuv420p", os.path.join(directory, "clip.mp4")],
+        check=True,
+    )
+    subprocess.run(
+        [ffmpeg, "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"sine=frequency=440:duration={narration_seconds}",
+         os.path.join(directory, "narration.mp3")],
+        check=True,
+    )
+
+# Function to write a script in the format asked to GPT
+def make_script(number_of_scenes):
+    lines = []
+    for number in range(1, number_of_scenes + 1):
+        lines.append(f"- Scene {number}: A calm landscape number {number} with slow clouds, warm colors and soft light.")
+        lines.append(f"- Narrator {number}: This is the narration of scene {number} of the benchmark video.")
+    return "\n".join(lines) + "\n"
+
+# Class to answer the OpenAI, Resemble, LumaAI and Google News requests of the pipeline
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def count_request(self):
+        with self.server.lock:
+            self.server.requests += 1
+
+    # Answer a 429 to the configured fraction of the API calls, like a provider whose quota has been reached
+    def throttle(self):
+        settings = self.server.settings
+        if random.random() >= settings.get("throttle_rate", 0):
+            return False
+        with self.server.lock:
+            self.server.throttled += 1
+        self.send_json({"error": "rate limited"}, 429, {"Retry-After": str(settings.get("retry_after", 1))})
+        return True
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        self.count_request()
+        if path.startswith("/media/"):
+            file_name = os.path.join(self.server.media_dir, os.path.basename(path))
+            with open(file_name, "rb") as file:
+                body = file.read()
+            self.send_response(200)
+            self.send_header("Content-Type", "video/mp4" if file_name.endswith(".mp4") else "audio/mpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == "/news":
+            items = "".join(
+                f"<item><title>Benchmark news {number}</title><link>http://example.com/{number}</link><description>Summary {number}</description></item>"
+                for number in range(10)
+            )
+            body = f"<?xml version='1.0'?><rss version='2.0'><channel><title>News</title>{items}</channel></rss>".encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/rss+xml")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == "/resemble/v2/projects":
+            if self.throttle():
+                return
+            self.send_json({"items": [{"uuid": "benchmark-project"}]})
+        elif path.startswith("/luma/generations/"):
+            if self.throttle():
+                return
+            generation_id = path.rsplit("/", 1)[1]
+            with self.server.lock:
+                generation = self.server.generations[generation_id]
+                self.server.polls += 1
+            if time.time() < generation["ready_at"]:
+                self.send_json({"id": generation_id, "state": "dreaming", "assets": None, "failure_reason": None})
+            elif generation["fails"]:
+                self.send_json({"id": generation_id, "state": "failed", "assets": None, "failure_reason": "Benchmark failure"})
+            else:
+                self.send_json({"id": generation_id, "state": "completed", "assets": {"video": f"{self.server.base_url}/media/clip.mp4"}, "failure_reason": None})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        self.count_request()
+        settings = self.server.settings
+        request = self.read_json()
+        if not path.startswith("/media/") and self.throttle():
+            return
+        if path == "/openai/v1/chat/completions":
+            self.answer_chat(request)
+        elif re.fullmatch(r"/resemble/v2/projects/[^/]+/clips", path):
+            time.sleep(settings["resemble_latency"])
+            self.send_json({"success": True, "item": {"uuid": uuid.uuid4().hex, "audio_src": f"{self.server.base_url}/media/narration.mp3"}})
+        elif path == "/luma/generations":
+            generation_id = uuid.uuid4().hex
+            latency = settings["luma_latency"] * random.uniform(1 - settings["luma_jitter"], 1 + settings["luma_jitter"])
+            with self.server.lock:
+                self.server.generations[generation_id] = {"ready_at": time.time() + latency, "fails": random.random() < settings["luma_failure_rate"]}
+            self.send_json({"id": generation_id, "state": "queued", "assets": None, "failure_reason": None}, 201)
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    # Answer a chat completion, streamed in small chunks spread over the configured latency when asked to
+    def answer_chat(self, request):
+        settings = self.server.settings
+        script = make_script(settings["scenes"])
+        if not request.get("stream"):
+            time.sleep(settings["openai_latency"])
+            self.send_json({
+                "id": "benchmark", "object": "chat.completion", "created": int(time.time()), "model": request.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": script}, "finish_reason": "stop"}],
+            })
+            return
+
+        chunks = [script[start:start + 20] for start in range(0, len(script), 20)]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for chunk in chunks:
+            time.sleep(settings["openai_latency"] / len(chunks))
+            event = {
+                "id": "benchmark", "object": "chat.completion.chunk", "created": int(time.time()), "model": request.get("model"),
+                "choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}],
+            }
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+# Function to start the stub server in a background thread
+def start_stub_server(settings, media_dir):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.settings = settings
+    server.media_dir = media_dir
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    server.generations = {}
+    server.polls = 0
+    server.requests = 0
+    server.throttled = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Function to get the environment variables that point the app to the stub server
+def stub_environment(server, work_dir):
+    return {
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": f"{server.base_url}/openai/v1",
+        "RESEMBLE_API_KEY": "benchmark",
+        "RESEMBLE_BASE_URL": f"{server.base_url}/resemble/",
+        "LUMAAI_API_KEY": "benchmark",
+        "LUMAAI_BASE_URL": f"{server.base_url}/luma",
+        "PBL_NEWS_RSS_URL": f"{server.base_url}/news?q=",
+        "PBL_CACHE_DIR": os.path.join(work_dir, "cache"),
+        "PBL_RUNS_DIR": os.path.join(work_dir, "runs"),
+    }
+
+# Function to render videos through the stubs and report the timings of every stage
+def benchmark_pipeline(arguments):
+    work_dir = tempfile.mkdtemp(prefix="pbl2024_benchmark_")
+    media_dir = os.path.join(work_dir, "media")
+    os.makedirs(media_dir)
+    make_sample_media(media_dir, arguments.clip_seconds, arguments.narration_seconds, arguments.clip_size)
+    settings = {
+        "scenes": arguments.scenes,
+        "openai_latency": arguments.openai_latency,
+        "resemble_latency": arguments.resemble_latency,
+        "luma_latency": arguments.luma_latency,
+        "luma_jitter": arguments.luma_jitter,
+        "luma_failure_rate": arguments.luma_failure_rate,
+        "throttle_rate": arguments.throttle_rate,
+        "retry_after": arguments.retry_after,
+    }
+    server = start_stub_server(settings, media_dir)
+
+    # The app reads its keys and endpoints from the environment when it runs outside Streamlit
+    os.environ.update(stub_environment(server, work_dir))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import pbl2024_app
+
+    reports = []
+    for number in range(arguments.runs):
+        params = {"query": f"benchmark {number} {uuid.uuid4().hex}", "source": "news", "num_needed": 3, "scenes": arguments.scenes, "word_limit": 50}
+        run_state = pbl2024_app.RunState(os.path.join(work_dir, "runs", f"run_{number}"), params)
+        start = time.time()
+        polls_before = server.polls
+        pbl2024_app.run_pipeline(run_state, arguments.scene_workers, progress=lambda message: None, report=lambda index, message: None, stream_script=not arguments.no_stream_script)
+        reports.append({"wall": round(time.time() - start, 3), "luma_polls": server.polls - polls_before, "generations_saved": run_state.data["generations_saved"], "rate_limits": run_state.data["rate_limits"], "trace": run_state.data["trace"]})
+        print(f"Run {number}: {reports[-1]['wall']} s, {reports[-1]['luma_polls']} LumaAI polls", flush=True)
+
+    server.shutdown()
+    report = {"settings": settings, "throttled": server.throttled, "scene_workers": arguments.scene_workers, "stream_script": not arguments.no_stream_script, "runs": reports}
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if not arguments.keep_files:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+# Function to time the start of the app and its reruns in fresh interpreters, counting the API requests they make
+def benchmark_startup(arguments):
+    work_dir = tempfile.mkdtemp(prefix="pbl2024_benchmark_")
+    settings = {"scenes": 1, "openai_latency": 0, "resemble_latency": 0, "luma_latency": 0, "luma_jitter": 0, "luma_failure_rate": 0}
+    server = start_stub_server(settings, work_dir)
+    environment = dict(os.environ, **stub_environment(server, work_dir))
+    environment["PYTHONPATH"] = os.path.dirname(os.path.abspath(__file__)) + os.pathsep + environment.get("PYTHONPATH", "")
+
+    reports = []
+    for number in range(arguments.runs):
+        requests_before = server.requests
+        result = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT.format(reruns=arguments.reruns)], env=environment, cwd=work_dir, capture_output=True, text=True, check=True)
+        timings = json.loads(result.stdout.strip().splitlines()[-1])
+        reports.append({
+            "import": round(timings["import"], 3),
+            "rerun": round(statistics.median(timings["reruns"]), 4) if timings["reruns"] else None,
+            "api_requests": server.requests - requests_before,
+        })
+        print(f"Run {number}: import {reports[-1]['import']} s, rerun {reports[-1]['rerun']} s, {reports[-1]['api_requests']} API requests", flush=True)
+
+    server.shutdown()
+    report = {
+        "import": statistics.median(report["import"] for report in reports),
+        "rerun": statistics.median(report["rerun"] for report in reports) if arguments.reruns else None,
+        "runs": reports,
+    }
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+# Function to check that every fit plays the scene videos at their speed or slower and covers the narration when it can
+def check_fits(arguments):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import pbl2024_app
+
+    failures = []
+    for method in ("loop", "pingpong", "retime"):
+        max_stretch = arguments.max_slowdown * (1 if method == "retime" else arguments.max_loops)
+        for step in range(1, arguments.steps + 1):
+            needed = 1 + (2 * arguments.max_slowdown - 1) * step / arguments.steps # Narration length over video length, in (1, 2 * max slowdown]
+            repeats, slowdown = pbl2024_app.plan_fit(1.0, needed, method, arguments.max_loops, arguments.max_slowdown)
+            if not 1.0 <= slowdown <= arguments.max_slowdown:
+                failures.append(f"{method} {needed:.3f}: slowdown {slowdown:.3f}")
+            if repeats * slowdown < min(needed, max_stretch) - 1e-6:
+                failures.append(f"{method} {needed:.3f}: covers {repeats * slowdown:.3f}")
+    print(f"{len(failures)} wrong fits" + "".join(f"\n  {failure}" for failure in failures))
+    if failures:
+        sys.exit(1)
+
+# MAIN CODE
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the educational video generation pipeline.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    pipeline = commands.add_parser("pipeline", help="Render videos against local stub servers and report the timings of every stage")
+    pipeline.add_argument("--runs", type=int, default=1, help="Videos rendered one after the other")
+    pipeline.add_argument("--scenes", type=int, default=5, help="Scenes of every video")
+    pipeline.add_argument("--scene-workers", type=int, default=3, help="Scenes generated at the same time")
+    pipeline.add_argument("--no-stream-script", action="store_true", help="Wait for the whole script before starting the scenes")
+    pipeline.add_argument("--openai-latency", type=float, default=5.0, help="Seconds to write the whole script")
+    pipeline.add_argument("--resemble-latency", type=float, default=2.0, help="Seconds to synthesize a narration")
+    pipeline.add_argument("--luma-latency", type=float, default=30.0, help="Seconds for a LumaAI generation to complete")
+    pipeline.add_argument("--luma-jitter", type=float, default=0.3, help="Relative random variation of the LumaAI latency")
+    pipeline.add_argument("--luma-failure-rate", type=float, default=0.0, help="Fraction of LumaAI generations that fail")
+    pipeline.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of the API calls answered with a 429")
+    pipeline.add_argument("--retry-after", type=float, default=1.0, help="Seconds asked to wait in the Retry-After header of a 429")
+    pipeline.add_argument("--clip-seconds", type=float, default=5.0, help="Length of the stub LumaAI clips")
+    pipeline.add_argument("--clip-size", default="1280x720", help="Size of the stub LumaAI clips")
+    pipeline.add_argument("--narration-seconds", type=float, default=8.0, help="Length of the stub narrations")
+    pipeline.add_argument("--output", help="JSON file for the report, printed if not given")
+    pipeline.add_argument("--keep-files", action="store_true", help="Keep the generated runs in the temporary folder")
+    pipeline.set_defaults(function=benchmark_pipeline)
+
+    startup = commands.add_parser("startup", help="Time the first import of the app and its reruns in fresh interpreters")
+    startup.add_argument("--runs", type=int, default=5, help="Fresh interpreters started one after the other")
+    startup.add_argument("--reruns", type=int, default=20, help="Reruns of the app timed in every interpreter")
+    startup.add_argument("--output", help="JSON file for the report, printed if not given")
+    startup.set_defaults(function=benchmark_startup)
+
+    fits = commands.add_parser("fits", help="Check how the scene videos are stretched to narrations longer than them")
+    fits.add_argument("--max-loops", type=int, default=2, help="Most times a scene video is played")
+    fits.add_argument("--max-slowdown", type=float, default=1.25, help="Most a scene video is slowed down")
+    fits.add_argument("--steps", type=int, default=100, help="Narration lengths checked for every method")
+    fits.set_defaults(function=check_fits)
+
+    arguments = parser.parse_args(arguments)
+    arguments.function(arguments)
+
+if __name__ == "__main__":
+    main()